@@ -1,15 +1,29 @@
 import os
-import datetime
+import io
+import shutil
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from slack_helper import *
+from slack_sdk.errors import SlackApiError
 from generate_prompt import *
 from generate_image import *
 from utils import *
 from archiver import *
 from vars import *
 from SlackbotMessages import SlackBotMessages
-from reformat_image import resize_image
-from dropbox_helper import upload_to_shared_folder
-from archiver import list_files_in_channel
+from reformat_image import resize_image_with_stats
+from png_encoder import encode_png, save_png
+from dropbox_helper import upload_to_shared_folder, upload_batch_to_shared_folder
+from archiver import list_files_in_channel, archive_files
+from archive_state import ArchiveState
+from job_queue import stage_limit
+from metrics import track_stage
+from workspace import JobWorkspace
+from progress import StatusMessage
+from checkpoints import Checkpoints, StageError
+from result_cache import ResultCache, hash_image
+import generate_image as image_generator
 
 messages = SlackBotMessages()
 
@@ -25,13 +39,30 @@ VALID_FLAGS = {
     "reformat",
     "inject",
     "series",
-    "archive"
+    "archive",
+    "resync",
+    "fresh"
 }
 
 valid_channels = set(CHANNEL_MAP.keys())
 
+SERIES_MAX_CONCURRENCY = int(os.getenv("SERIES_MAX_CONCURRENCY", 3)) # Variants of one series generated at once
+
+IN_MEMORY_PIPELINE = os.getenv("IN_MEMORY_PIPELINE", "0") == "1" # Keep outputs in memory from resize to delivery
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "0") == "1"
+OUTPUT_SIZE = (4500, 5400)
+
+# The cache stores every output on disk, so it is never used by the in-memory pipeline
+result_cache = ResultCache() if RESULT_CACHE_ENABLED and not IN_MEMORY_PIPELINE else None
+
+ARCHIVE_START_DATE = os.getenv("ARCHIVE_START_DATE", "2025-01-01") # Where a full resync starts scanning
+ARCHIVE_WATERMARK_OVERLAP = int(os.getenv("ARCHIVE_WATERMARK_OVERLAP", 300)) # Seconds rescanned before the watermark
+
+SLACK_DELIVERY_TIMEOUT = float(os.getenv("SLACK_DELIVERY_TIMEOUT", 600)) # Seconds to wait for a job's Slack uploads
+
 class EventHandler:
-    def __init__(self, logger, event_type: str, channel_id: str, user: str, text: str, files: list):
+    def __init__(self, logger, event_type: str, channel_id: str, user: str, text: str, files: list, job_id: str = None):
         if channel_id not in valid_channels:
             return 
         
@@ -41,6 +72,7 @@ class EventHandler:
         self.event_type = event_type # app_mention, file_shared, message, etc.
         self.channel_id = channel_id
         self.input_filename = None
+        self.input_name = None # File name sent to the image API when the input is held in memory
 
         self.dropbox_folder_id = CHANNEL_MAP[channel_id]
         
@@ -59,32 +91,84 @@ class EventHandler:
         self.series = False # Allows the user to enter iterative arguments to create a batch from one image or prompt. 
         self.archive = False # Will prompt the bot to output all of the generated files to Dropbox
         self.allow_archive = False # This parameter must be manually changed to True to allow archiving
+        self.resync = False # Ignores the archive watermark and manifest and archives every file again
+        self.fresh = False # Skips the result cache and always generates a new image
 
         # Series Attributes
-        self.series_params = None
-        self.series_iterator = 0
+        self.series_params = None # Each variant receives its own index into these, see _run_series
 
-        try:
-            # Save memory by removing any existing folder structures from the app
-            remove_directory_recursively("user_submitted_files")
-            remove_directory_recursively("image_outputs")
-        except:
-            pass
+        self.workspace = None # Private scratch directory, created when the job starts
+        self.status = None # The job's progress message, edited in place as the job advances
+        self.pending_uploads = [] # Series (output, filename, output key) waiting to be committed to Dropbox together
+        self._lock = threading.Lock() # Guards state shared by concurrent series variants
 
-        self._mkdirs("user_submitted_files")
-        self._mkdirs("image_outputs")
+        # Stage checkpoints, so a retry of the job resumes where this run failed
+        self.job_id = job_id # Id of the job in the job store, None when the job is not stored
+        # The in-memory pipeline writes no stage artifacts, so its retries download and generate again
+        self.checkpoints = Checkpoints(job_id, keep_files=not IN_MEMORY_PIPELINE)
+        self.input_key = None # Identifies the current input (a Slack file, or the prompt) in checkpoint stage names
+        self.deliveries = [] # (stage, Future) of the Slack uploads of this run
+        self.failed_stages = [] # Stages that failed in this run and should be retried
 
         self._set_flags()
 
     def handle_event(self):
         """
-            Delegates the handling of the message to the specified function. 
+            Delegates the handling of the message to the specified function.
+            The job runs inside its own workspace which is removed when the job ends.
+        """
+        self.status = StatusMessage(self.channel_id)
+        try:
+            with JobWorkspace() as self.workspace:
+                self.logger.info(f"Job workspace: {self.workspace.root}")
+                if self.event_type == "app_mention":
+                    self.logger.info("Handling app_mention...")
+                    self._handle_app_mention()
+                elif self.event_type == "file_shared":
+                    self._handle_files_shared()
+            self._finish_stages()
+        finally:
+            self.status.close()
+            if self.job_id is None:
+                self.checkpoints.clear()
+
+    def _finish_stages(self):
+        """
+            Waits for this run's Slack uploads and records the ones that went through.
+        """
+        for stage, delivery in self.deliveries:
+            try:
+                delivery.result(timeout=SLACK_DELIVERY_TIMEOUT)
+                self.checkpoints.save(stage)
+            except Exception as e:
+                self.failed_stages.append(f"{stage} ({e})")
+
+        self._close_stages()
+
+    def _close_stages(self):
+        """
+            If a stage failed the checkpoints are kept and StageError is raised, so the job store retries
+            the job from that stage. Otherwise the job is finished and its checkpoints are removed.
         """
-        if self.event_type == "app_mention":
-            self.logger.info("Handling app_mention...")
-            self._handle_app_mention()
-        elif self.event_type == "file_shared":
-            self._handle_files_shared()    
+        if self.failed_stages:
+            raise StageError(f"Stages to retry: {', '.join(self.failed_stages)}")
+        self.checkpoints.clear()
+
+    def _output_key(self, series_index=None):
+        """
+            Names one output of the job in checkpoint stage names: the input and the series variant.
+        """
+        return f"{self.input_key}:{0 if series_index is None else series_index}"
+
+    def _report(self, message, verbose=True):
+        """
+            Adds a progress line to the job's status message instead of posting a new message.
+            Lines marked verbose are only shown when the --verbose flag is set.
+            Errors, help and summaries are still posted as their own messages.
+        """
+        if verbose and not self.verbose:
+            return
+        self.status.update(message)
 
     def _handle_app_mention(self):
         """
@@ -95,23 +179,31 @@ class EventHandler:
             If no file is submitted it invokes the direct prompt image generator.
         """
         if self.help: # If the help flag is present
-            message = messages.HelpMessage(self.user)
+            message = messages.HelpMessage(self.user, fresh=result_cache is not None)
             send_message(self.channel_id, message)
 
         if self.archive and self.allow_archive:
             self._handle_archive()
-            
-        if self.series: # Returns the list of series params
-            self.series_params = get_series_params(clean_text(self.text))
-            if not (len(self.series_params[0])) or (len(self.files) > 1): # The series must contain parameters and only 1 file
-                send_message(self.channel_id, messages.SeriesError)
-                return
+
+        if self.series and not self._read_series_params():
+            return
 
         if self.files: # The user has submitted a file to be edited
             self._handle_files_shared()
         else: # The user has not submitted a file to be edited
             self._handle_direct_prompt()
 
+    def _read_series_params(self):
+        """
+            Reads the series arguments from the message.
+            Returns False after telling the user when they cannot be used.
+        """
+        self.series_params = get_series_params(clean_text(self.text))
+        if not (len(self.series_params[0])) or (len(self.files) > 1): # The series must contain parameters and only 1 file
+            send_message(self.channel_id, messages.SeriesError)
+            return False
+        return True
+
     def _handle_files_shared(self):
         """
             Sends each file in the batch off to be handled by the file handler.
@@ -128,32 +220,46 @@ class EventHandler:
             It then uploads the image along with the prompt to the OpenAI image generation API.
             The file is then sent through the slack channel. 
         """
-        if file:
-            ext = file.get("filetype").lower()
-        else:
-            ext = "png"
+        ext = self._select_input(file)
 
         if self.reformat:
-            self._get_file_from_user(file, ext)
-            # Just reformat the image and send it
-            output_filename = f"image_outputs/gen_image_{self.input_filename.split('/')[-1][:-4]}.{ext}"
-            send_message(self.channel_id, messages.GeneratorConfirmation(output_filename.split('/')[-1]))
+            self.input_filename = self._get_file_from_user(file, ext)
+            if not self.input_filename:
+                return
+            # Just reformat the image and send it, encoded as PNG like every other output
+            output_filename = self._name_output(self._input_stem())
 
             self._handle_image_reformatting(output_filename)
-            self._cleanup()
+            self._cleanup(output_filename, self.input_filename)
             return
-        
+
         # SERIES Handling
         if self.series:
-            while self.series_iterator < len(self.series_params[0]):
-                self._get_file_from_user(file, ext)
-                self._facilitate_output(self.input_filename.split('/')[-1][:-4])
-                self.series_iterator += 1
+            # Fetch the seed once, every variant edits the same read-only bytes
+            seed_image = self._get_file_from_user(file, ext, in_memory=True)
+            if seed_image is None:
+                return
+            stem = JobWorkspace.unique_stem()
+
+            self._run_series(
+                lambda series_index: self._facilitate_output(f"{stem}-{series_index + 1}", series_index, seed_image)
+            )
         
         else:
-            self._get_file_from_user(file, ext)
-            self._facilitate_output(self.input_filename.split('/')[-1][:-4])
-    
+            self.input_filename = self._get_file_from_user(file, ext)
+            if not self.input_filename:
+                return
+            self._facilitate_output(self._input_stem(), input_image=self.input_filename)
+
+    def _select_input(self, file):
+        """
+            Makes file the current input, naming it in checkpoint stage names. Returns its extension.
+        """
+        if not file:
+            return "png"
+        self.input_key = file.get("id") or file.get("name")
+        return file.get("filetype").lower()
+
     def _handle_direct_prompt(self):
         """
         The function directly takes a prompt as a message and delivers an image directly.
@@ -166,105 +272,300 @@ class EventHandler:
             return
         
         self.mode = "prompt-only"
+        self.input_key = "prompt"
         
         # SERIES Handling
         if self.series:
-            while self.series_iterator < len(self.series_params[0]):
-                # Name the file for output
-                now = datetime.datetime.now()
-                self._facilitate_output(now.strftime('%Y-%m-%d-%H-%M-%S'))
-                self.series_iterator += 1
+            # Name the file for output
+            self._run_series(lambda series_index: self._facilitate_output(JobWorkspace.unique_stem(), series_index))
 
         else:
             # Name the file for output
-            now = datetime.datetime.now()
-            self._facilitate_output(now.strftime('%Y-%m-%d-%H-%M-%S'))
+            self._facilitate_output(JobWorkspace.unique_stem())
 
     def _handle_archive(self):
         """
             Archives the image files sent by slack bot and sends them to the dropbox folder 
             corresponding to the current channel.
+            Files are downloaded and uploaded concurrently; progress is reported as the archive runs
+            and a per-file summary is posted at the end.
+            Only messages after the channel's watermark are scanned and files already in the manifest
+            are skipped, unless --resync is given.
         """
-        successes = 0
-        send_message(self.channel_id, messages.ArchiveConfirmation)
-        start_ts = to_unix_timestamp("2025-01-01") # Start of the year
-        _, end_ts = get_today_unix_range()
-
-        files = list_files_in_channel(self.channel_id, start_ts, end_ts)
-
-        send_message(self.channel_id, f"{len(files)} # of files found.")
-
-        for file in files:
-            endpoint = file.get('name')
-            if not endpoint or endpoint == "error":
-                continue
-            filename = "image_outputs/" + endpoint
-            url = file.get('url_private', '')
-            if url:
-                download_slack_file(url, filename)
-                response = upload_to_shared_folder(filename, self.dropbox_folder_id)
-                if (response.get("error")):
-                    pass
-                else:
-                    successes += 1
-                    
-        if successes == len(files):
-            send_message(self.channel_id, messages.DropboxSuccessful + " for all files in batch.")
+        self._report(messages.ArchiveConfirmation, verbose=False)
+        state = ArchiveState()
+
+        if self.resync:
+            state.reset(self.channel_id)
+            watermark = None
+        else:
+            watermark = state.get_watermark(self.channel_id)
+
+        if watermark:
+            start_ts = watermark - ARCHIVE_WATERMARK_OVERLAP
+        else:
+            start_ts = to_unix_timestamp(ARCHIVE_START_DATE)
+        end_ts = int(time.time())
+
+        try:
+            with stage_limit("slack"):
+                files = list_files_in_channel(self.channel_id, start_ts, end_ts)
+        except SlackApiError as e:
+            # Nothing is marked archived and the watermark stays put, so the next run scans this window again
+            self.logger.error(f"Could not list the files of {self.channel_id}: {e.response['error']}")
+            send_message(self.channel_id, messages.ArchiveListError(e.response["error"]))
+            return
+
+        archived = state.archived_keys(self.channel_id)
+        files = [file for file in files if ArchiveState.file_key(file) not in archived]
+
+        self._report(f"{len(files)} # of files found.", verbose=False)
+
+        def report_progress(done, total):
+            self._report(messages.ArchiveProgress(done, total), verbose=False)
+
+        with track_stage("archive"):
+            results = archive_files(files, self.dropbox_folder_id, self.workspace.output_dir, report_progress)
+
+        failures = [result for result in results if result["error"]]
+        state.mark_archived(self.channel_id, [result["file"] for result in results if not result["error"]])
+
+        # Advance the watermark to this scan, or only up to the earliest failure so it is retried next run.
+        # The history is filtered on message ts, so the watermark is too, not on when a file was created
+        failed_timestamps = [result["file"].get("message_ts") or start_ts for result in failures]
+        if failed_timestamps:
+            state.set_watermark(self.channel_id, max(min(failed_timestamps) - 1, start_ts))
+        else:
+            state.set_watermark(self.channel_id, end_ts)
+
+        send_message(self.channel_id, messages.ArchiveSummary(len(results) - len(failures), failures))
+
+        if results and not failures:
+            self._report(messages.DropboxSuccessful + " for all files in batch.", verbose=False)
                 
 
-    def _facilitate_output(self, input_filename):
+    def _run_series(self, run_variant):
+        """
+            Runs run_variant(series_index) for every variant of the series concurrently.
+            At most SERIES_MAX_CONCURRENCY variants of this job run at once, and the "series" stage limit
+            caps the variants running across all jobs. Each variant posts its result as soon as it finishes;
+            the Dropbox uploads are committed together at the end.
+        """
+        count = len(self.series_params[0])
+
+        def run_limited(series_index):
+            with stage_limit("series"):
+                run_variant(series_index)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(SERIES_MAX_CONCURRENCY, count))) as executor:
+            futures = [executor.submit(run_limited, i) for i in range(count)]
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(f"Series variant failed: {e}")
+
+        self._flush_pending_uploads()
+
+    def _facilitate_output(self, stem, series_index=None, input_image=None):
         """
             Handles the naming of the output file, sending confirmation messages.
             Calls the generate image and send function. 
+            series_index selects the series arguments of this variant.
+            input_image is the image to edit, either the path of the downloaded file or its bytes.
         """
-        # Unconditionally set the extension to png if it is being generated
-        output_filename = f"image_outputs/gen_image_{input_filename}.png" 
-        send_message(self.channel_id, messages.GeneratorConfirmation(output_filename.split('/')[-1]))
+        output_filename = self._name_output(stem)
+
+        self._report(messages.VerboseConfirmation)
 
-        if self.verbose:
-            send_message(self.channel_id, messages.VerboseConfirmation)
+        self._generate_image_and_send(output_filename, series_index, input_image)
 
-        self._generate_image_and_send(output_filename)
+    def _name_output(self, stem):
+        """
+            Returns the path of an output in the job's workspace and tells the user its name.
+            Outputs are always encoded by save_png, so they are always named .png, even when reformatting a JPEG.
+        """
+        output_filename = self.workspace.output_path(f"gen_image_{stem}.png")
+        self._report(messages.GeneratorConfirmation(os.path.basename(output_filename)), verbose=False)
+        return output_filename
 
-    def _get_file_from_user(self, file, ext):
+    def _get_file_from_user(self, file, ext, in_memory=False):
         """
             Function handles trying to download the file that a user attached to the message.
-            As a side effect it generates the input filename for use later. 
+            Returns the path of the downloaded file, named uniquely in the job's workspace,
+            or its bytes when in_memory is set.
+            Returns None and tells the user if the file could not be downloaded.
         """
-        # Name the file that will be saved from the User's message
-        now = datetime.datetime.now()
-        self.input_filename = f"user_submitted_files/{now.strftime('%Y-%m-%d-%H-%M-%S')}.{ext}"
+        stage = f"download:{self.input_key}"
+        resumed = self._resumed_input(stage, ext, in_memory)
+        if resumed is not None:
+            return resumed
+
+        destination = self._input_destination(ext, in_memory)
 
         # From slack helper
-        download_slack_file(file["url_private"], self.input_filename)
-        if self.verbose:
-            send_message(self.channel_id, messages.Download)
-    
-    def _generate_image_and_send(self, output_filename):
+        try:
+            # download_slack_file takes the slack slot per attempt, so its retry waits do not hold one
+            with track_stage("download"):
+                download_slack_file(file["url_private"], destination, expected_size=file.get("size"))
+        except SlackDownloadError as e:
+            return self._download_failed(file, e)
+
+        return self._record_input(stage, destination)
+
+    def _resumed_input(self, stage, ext, in_memory=False):
+        """
+            Returns the input an earlier run of the job downloaded, as a path or as bytes, or None.
+        """
+        if in_memory:
+            self.input_name = f"seed.{ext}"
+            return self.checkpoints.read(stage)
+        return self.checkpoints.file(stage)
+
+    def _input_destination(self, ext, in_memory=False):
+        """
+            Returns where the download of the input is written: a buffer, or a uniquely named file.
+        """
+        if in_memory:
+            return io.BytesIO()
+        # Name the file that will be saved from the User's message
+        return self._artifact_path(f"{JobWorkspace.unique_stem()}.{ext}")
+
+    def _artifact_path(self, name):
+        """
+            Returns where a stage artifact is written: the job's checkpoint directory when a retry of the job
+            can resume from it, the job's workspace otherwise.
+        """
+        if self.checkpoints.keeps_files:
+            return self.checkpoints.path(name)
+        return self.workspace.output_path(name)
+
+    def _record_input(self, stage, destination):
+        """
+            Checkpoints a finished download and returns the input as a path, or as bytes when it was downloaded to a buffer.
+        """
+        if hasattr(destination, "read"):
+            input_image = destination.getvalue()
+            self.checkpoints.save_file(stage, self.input_name, input_image)
+        else:
+            input_image = destination
+            self.checkpoints.save_file(stage, os.path.basename(destination), destination)
+
+        self._report(messages.Download)
+        return input_image
+
+    def _download_failed(self, file, error):
+        self.logger.error(f"Download of {file.get('name')} failed: {error}")
+        send_message(self.channel_id, messages.DownloadError(error))
+        return None
+
+    def _generate_image_and_send(self, output_filename, series_index=None, input_image=None):
         """
             Handles the end stage of the image generation process. It makes a call to the image prompter and generator.
-            Handles the resizing and sends the message. 
+            Handles the resizing and sends the message.
             This function acts as an intermediary between the caller and the _handle_image_prompt_and_generation function.
-        
         """
-        if self._handle_image_prompt_and_generation(output_filename) == 200:
-            # Send the output to dropbox
-            send_message(self.channel_id, messages.AttemptingDropbox)
+        output = self._handle_image_prompt_and_generation(output_filename, series_index, input_image)
+        if output is None:
+            return
 
-            try:
-                response = upload_to_shared_folder(output_filename, self.dropbox_folder_id)
+        self._send_output(output, output_filename, series_index, input_image)
+
+    def _send_output(self, output, output_filename, series_index=None, input_image=None):
+        """
+            Sends one output to Dropbox (with the rest of the series when it is part of one) and to Slack.
+            Dropbox and Slack deliveries that an earlier run of the job already made are skipped.
+        """
+        key = self._output_key(series_index)
+        file_name = os.path.basename(output_filename)
+
+        if self.series:
+            # Series outputs are committed to Dropbox together when the series is complete
+            if not self.checkpoints.done(f"dropbox:{key}"):
+                with self._lock:
+                    self.pending_uploads.append((output, file_name, key))
+            self._deliver(key, output, file_name)
+            self._cleanup(None, input_image if isinstance(input_image, str) else None)
+            return
+
+        # Send the output to dropbox
+        self._upload_to_dropbox(key, output, file_name)
+
+        self._deliver(key, output, file_name)
+        self._cleanup(output_filename, input_image if isinstance(input_image, str) else None)
+
+    def _upload_to_dropbox(self, key, output, file_name):
+        """
+            Uploads one output to the channel's Dropbox folder, unless an earlier run of the job already did.
+        """
+        stage = f"dropbox:{key}"
+        if self.checkpoints.done(stage):
+            return
+
+        self._report(messages.AttemptingDropbox, verbose=False)
+        try:
+            with stage_limit("dropbox"), track_stage("dropbox") as run:
+                response = upload_to_shared_folder(output, self.dropbox_folder_id, file_name)
                 if response.get("error"):
-                    send_message(self.channel_id, messages.DropboxUploadError(response))
-                else:
-                    send_message(self.channel_id, messages.DropboxSuccessful)
-            except Exception as e:
-                print(f"Dropbox file upload failed: {e}")
+                    run.fail()
+        except Exception as e:
+            print(f"Dropbox file upload failed: {e}")
+            self.failed_stages.append(stage)
+            return
 
-            send_file(self.channel_id, output_filename)
-            self._cleanup(output_filename)
+        if self._record_dropbox(stage, response):
+            self._report(messages.DropboxSuccessful, verbose=False)
 
-        
-    def _handle_image_prompt_and_generation(self, output_filename):
+    def _record_dropbox(self, stage, response):
+        """
+            Checkpoints a successful Dropbox upload, or tells the user and marks the stage for a retry.
+        """
+        if response.get("error"):
+            send_message(self.channel_id, messages.DropboxUploadError(response))
+            self.failed_stages.append(stage)
+            return False
+
+        self.checkpoints.save(stage)
+        return True
+
+    def _deliver(self, key, output, file_name, **kwargs):
+        """
+            Queues the Slack upload of one output, unless an earlier run of the job already sent it.
+            The upload is checkpointed once it has gone through, see _finish_stages.
+        """
+        stage = f"slack:{key}"
+        if self.checkpoints.done(stage):
+            return
+
+        delivery = send_file(self.channel_id, output, file_name=file_name, **kwargs)
+        with self._lock:
+            self.deliveries.append((stage, delivery))
+
+    def _flush_pending_uploads(self):
+        """
+            Sends the outputs of a series to Dropbox together once every variant has been generated.
+        """
+        if not self.pending_uploads:
+            return
+
+        self._report(messages.AttemptingDropbox, verbose=False)
+        with stage_limit("dropbox"), track_stage("dropbox") as run:
+            results = upload_batch_to_shared_folder(
+                [(output, file_name) for output, file_name, _ in self.pending_uploads], self.dropbox_folder_id
+            )
+            if any(response.get("error") for response in results):
+                run.fail()
+
+        for (output, _, key), response in zip(self.pending_uploads, results):
+            self._record_dropbox(f"dropbox:{key}", response)
+            self._cleanup(output)
+
+        if not any(response.get("error") for response in results):
+            self._report(messages.DropboxSuccessful + " for all files in batch.", verbose=False)
+
+        self.pending_uploads = []
+
+    def _handle_image_prompt_and_generation(self, output_filename, series_index=None, input_image=None):
         """"
             Generates the image prompt and the generation of an Ai generated image.
             It handles the cases of prompt-only and image-edit.
@@ -273,88 +574,186 @@ class EventHandler:
                 image-edit: An image has been uploaded to the message. The generator will use the client.image.edit method
                     to try to edit the given image and return a suitable design.
         """
+        key = self._output_key(series_index)
         try:
-            generated_prompt = self._generate_prompt(self.mode)
+            output = self._resumed_output(key)
+            if output is not None:
+                return output
 
-            generated_image = self._generate_image(self.mode, generated_prompt)
+            generated_prompt = self.checkpoints.get(f"prompt:{key}")
+            if generated_prompt is None:
+                generated_prompt = self._generate_prompt(self.mode, series_index)
+                self.checkpoints.save(f"prompt:{key}", generated_prompt)
 
-            # Reformat the image to proper dimensions and specs
-            generated_image = resize_image(generated_image)
-            
-            self.logger.info("Image Resized")
-            if self.verbose:
-                send_message(self.channel_id, messages.ImageResized)
+            cache_key, output = self._cached_result(generated_prompt, input_image, output_filename)
+            if output is not None:
+                return output
 
-            generated_image.save(output_filename, dpi=(300, 300))
-            if self.verbose:
-                send_message(self.channel_id, messages.TrySending)
-            self.logger.info(f"Generated image saved to {output_filename}")
+            generated_image = self.checkpoints.read(f"generate:{key}")
+            if generated_image is None:
+                generated_image = self._generate_image(self.mode, generated_prompt, input_image)
+                self._checkpoint_generation(key, generated_image)
+
+            return self._finish_output(key, generated_image, output_filename, cache_key)
 
-            return 200
-        
         except Exception as e:
-            send_message(self.channel_id, messages.GeneratorError(e))
-            print(f"Image generation could not be completed. {e}")
+            self._generation_failed(e)
 
-    def _generate_prompt(self, mode):
+    def _resumed_output(self, key):
+        """
+            Returns the output an earlier run of the job finished for key, or None.
+        """
+        output = self._checkpointed_output(key)
+        if output is not None:
+            # An earlier run of the job got this far, go straight to delivery
+            self.logger.info(f"Resuming {key} from its checkpointed output")
+        return output
+
+    def _cached_result(self, generated_prompt, input_image, output_filename):
+        """
+            Returns the result cache key of this request and the cached output, or None for either
+            when the result cache is disabled, misses or --fresh was given.
+        """
+        cache_key = self._result_cache_key(generated_prompt, input_image)
+        if not cache_key:
+            return None, None
+
+        cached = None if self.fresh else result_cache.get(cache_key)
+        if not cached:
+            return cache_key, None
+
+        # The same request has been generated before, go straight to delivery
+        self.logger.info(f"Result cache hit {cache_key}")
+        return cache_key, self._load_cached_output(cached, output_filename)
+
+    def _checkpoint_generation(self, key, generated_image):
+        if generated_image is not None:
+            # The generation is paid for, keep it whatever happens to the later stages
+            self.checkpoints.save_file(f"generate:{key}", f"generated_{key}.png", generated_image)
+
+    def _finish_output(self, key, generated_image, output_filename, cache_key=None):
+        """
+            Resizes and encodes a generated image into the output of key, checkpoints it
+            and adds it to the result cache. Returns the output.
+        """
+        # Reformat the image to proper dimensions and specs
+        with track_stage("resize"):
+            generated_image, resize_stats = resize_image_with_stats(generated_image, OUTPUT_SIZE)
+
+        self.logger.info(f"Image Resized {self._format_resize_stats(resize_stats)}")
+        self._report(messages.ImageResized)
+
+        output = self._save_output(generated_image, self._artifact_path(os.path.basename(output_filename)))
+        self._checkpoint_output(key, output)
+        self._report(messages.TrySending)
+        self.logger.info(f"Generated image saved to {output if isinstance(output, str) else 'memory'}")
+
+        if cache_key:
+            result_cache.put(cache_key, output)
+
+        return output
+
+    def _generation_failed(self, error):
+        send_message(self.channel_id, messages.GeneratorError(error))
+        print(f"Image generation could not be completed. {error}")
+
+    def _result_cache_key(self, generated_prompt, input_image=None):
+        """
+            Returns the result cache key of this request, or None when the result cache is disabled.
+        """
+        if result_cache is None:
+            return None
+        return ResultCache.key(
+            hash_image(input_image if self.mode == "image-edit" else None),
+            generated_prompt,
+            image_generator.model,
+            f"{image_generator.size}->{OUTPUT_SIZE[0]}x{OUTPUT_SIZE[1]}"
+        )
+
+    def _injection_text(self, series_index=None):
+        """
+            Returns the user's text to inject into the prompt with this variant's series arguments substituted,
+            or None when --inject was not given.
+        """
+        if not self.inject:
+            return None
+
+        # Inject the clean text into the prompt to help add instructions.
+        text = clean_text(self.text)
+
+        # SERIES Handling
+        if self.series:
+            series_replacements = get_series(self.text)
+
+            for i, s in enumerate(series_replacements):
+                # Replace the series arguments with the argument of this variant.
+                text = text.replace(s, self.series_params[i][series_index])
+        return text
+
+    def _generate_prompt(self, mode, series_index=None):
         """
             Create the prompt needed to generate the image. 
             Handles the case where a vanilla prompt is entered and when an Image is being edited. 
+            series_index selects which series arguments are substituted into the injection.
         
         """
-        if self.inject:
-            # Inject the clean text into the prompt to help add instructions.
-            text = clean_text(self.text)
-
-            # SERIES Handling
-            if self.series:
-                series_replacements = get_series(self.text)
+        text = self._injection_text(series_index)
 
-                for i, s in enumerate(series_replacements):
-                    # Replace the series arguments with the current argument via the iterator.
-                    text = text.replace(s, self.series_params[i][self.series_iterator])
-            
         # Get the dense prompt
         if mode == "prompt-only":
             # This will only run if inject is true as it's being handled in the parent function
-            generated_prompt = generate_prompt(mode="prompt-only", injection=text)
-            generated_prompt += " Ensure the image has a transparent background."
-        
+            with stage_limit("openai"), track_stage("prompt"):
+                generated_prompt = generate_prompt(mode="prompt-only", injection=text)
+
         if mode == "image-edit":
             # Just return the boilerplate prompt
-            if self.inject:
-                generated_prompt = generate_prompt(mode="image-edit") + text
-            else:
-                print("generating prompt...")
+            with track_stage("prompt"):
                 generated_prompt = generate_prompt(mode="image-edit")
 
+        return self._prompt_generated(mode, generated_prompt, text)
+
+    def _prompt_generated(self, mode, generated_prompt, text=None):
+        """
+            Completes the prompt returned for mode with the user's text and reports it.
+        """
+        if mode == "prompt-only":
+            generated_prompt += " Ensure the image has a transparent background."
+        elif text:
+            generated_prompt += text
+
         self.logger.info("Prompt generated")
-        if self.verbose:
-            send_message(self.channel_id, messages.PromptGenerated)
-            send_message(self.channel_id, generated_prompt)
-        
+        self._report(messages.PromptGenerated)
+        self._report(generated_prompt)
+
         return generated_prompt
-    
-    def _generate_image(self, mode, generated_prompt):
+
+    def _generate_image(self, mode, generated_prompt, input_image=None):
         """
-            Makes the call to generate the image based on whether the mode is prompt-only or image-edit. 
+            Makes the call to generate the image based on whether the mode is prompt-only or image-edit.
         """
         # Make a call to OpenAi image generation model based on the prompt
-        if mode == "prompt-only":
-            generated_image = generate_image(self.logger, generated_prompt)
+        with stage_limit("openai"), track_stage("generate") as run:
+            if mode == "prompt-only":
+                generated_image = generate_image(self.logger, generated_prompt)
 
-        if mode == "image-edit":
-            generated_image = edit_image(self.logger, generated_prompt, self.input_filename)
+            if mode == "image-edit":
+                generated_image = edit_image(self.logger, generated_prompt, input_image, self.input_name)
+
+            if isinstance(generated_image, dict) and generated_image.get("error"):
+                run.fail()
 
+        return self._image_generated(generated_image)
+
+    def _image_generated(self, generated_image):
+        """
+            Returns the generated image bytes, or None after telling the user when the generation failed.
+        """
         if isinstance(generated_image, dict) and generated_image.get("error"):
             send_message(self.channel_id, messages.GeneratorError(generated_image["error"]))
-            return
-        else:
-            generated_image = generated_image  # bytes
+            return None
+
+        self._report(messages.ImageGenerated)
 
-        if self.verbose: 
-            send_message(self.channel_id, messages.ImageGenerated)
-        
         return generated_image
 
     def _handle_image_reformatting(self, output_filename):
@@ -362,45 +761,89 @@ class EventHandler:
             Function is called when the --reformat flag is invoked.
             It more directly and succinctly downloads the submitted image and reformats it to the correct size.
         """
+        key = self._output_key()
+        file_name = os.path.basename(output_filename)
+
+        output = self._checkpointed_output(key)
+        if output is None:
+            output = self._reformat_input(key, file_name)
+
+        # Send the output to dropbox
+        self._upload_to_dropbox(key, output, file_name)
+
+        # Send the output to slack
+        self._deliver(key, output, file_name, message="Here's your reformatted image!")
+
+    def _reformat_input(self, key, file_name):
+        """
+            Resizes the submitted image to the output size, encodes it as the output of key and checkpoints it.
+        """
         # Only handle tasks related to reformating the image submitted.
         with open(self.input_filename, "rb") as f:
             image_bytes = f.read()
 
-        if self.verbose:
-            send_message(self.channel_id, "Resizing image...")
-        resized_image = resize_image(image_bytes)
-        
-        if self.verbose:
-            send_message(self.channel_id, "Saving result...")
-            
-        resized_image.save(output_filename, dpi=(300, 300))
+        self._report("Resizing image...")
+        with track_stage("resize"):
+            resized_image, resize_stats = resize_image_with_stats(image_bytes)
+        self.logger.info(f"Image Resized {self._format_resize_stats(resize_stats)}")
 
-        if self.verbose:
-            send_message(self.channel_id, messages.ImageSaved)
+        self._report("Saving result...")
 
-        # Send the output to dropbox
-        send_message(self.channel_id, messages.AttemptingDropbox)
-        try:    
-            upload_to_shared_folder(output_filename, self.dropbox_folder_id)
-        except Exception as e:
-            send_message(self.channel_id, messages.DropboxUploadError(e))
+        output = self._save_output(resized_image, self._artifact_path(file_name))
+        self._checkpoint_output(key, output)
 
-        send_message(self.channel_id, messages.DropboxSuccessful)
+        self._report(messages.ImageSaved)
+        return output
 
-        # Send the output to slack    
-        send_file(self.channel_id, output_filename, "Here's your reformatted image!")
+    def _checkpointed_output(self, key):
+        """
+            Returns the encoded output an earlier run of the job saved for key, or None.
+        """
+        return self.checkpoints.file(f"output:{key}")
 
+    def _checkpoint_output(self, key, output):
+        """
+            Records the encoded output of key. Outputs of a stored job are already written to its checkpoint directory;
+            in the in-memory pipeline nothing is written out.
+        """
+        if isinstance(output, str):
+            self.checkpoints.save_file(f"output:{key}", os.path.basename(output), output)
 
-    def _mkdirs(self, folder_path):
+    def _load_cached_output(self, cached_path, output_filename):
         """
-            Initializes the necessary folders used for image saving and generation.
+            Copies a cached output into the job as output_filename, so cleaning up the job never removes the cache entry.
+            The cache is disabled in the in-memory pipeline, so this always writes a file.
         """
-        # Check if the folder exists
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-            self.logger.info(f"Created directory: {folder_path}")
-        else:
-            self.logger.info(f"Directory already exists: {folder_path}")
+        shutil.copyfile(cached_path, output_filename)
+        return output_filename
+
+    def _save_output(self, image, output_filename):
+        """
+            Encodes the finished image exactly once with the configured PNG profile and encoder.
+            In the in-memory pipeline the encoded PNG buffer is returned and fed to both the Dropbox and Slack uploads,
+            otherwise the image is saved to output_filename and the path is returned.
+        """
+        with track_stage("encode"):
+            if IN_MEMORY_PIPELINE:
+                return encode_png(image)
+
+            save_png(image, output_filename)
+            return output_filename
+
+
+    @staticmethod
+    def _format_resize_stats(stats):
+        mb = 1024 * 1024
+        growth = stats["peak_rss_growth_bytes"]
+        measured = "n/a" if growth is None else f"{growth / mb:.1f} MB"
+        return (f"(filter: {stats['filter']}, peak RSS growth: {measured}, estimated buffers: {stats['estimated_buffer_bytes'] / mb:.1f} MB, "
+                f"output: {stats['output_bytes'] / mb:.1f} MB, process max RSS so far: {stats['process_max_rss_bytes'] / mb:.1f} MB)")
+
+    def _input_stem(self, input_filename=None):
+        """
+            Returns the name of the input file (the current one by default) without its folder or extension.
+        """
+        return os.path.splitext(os.path.basename(input_filename or self.input_filename))[0]
 
     def _set_flags(self):
         """
@@ -413,17 +856,15 @@ class EventHandler:
             if flag in self.flags:
                 setattr(self, flag, True) 
 
-    def _cleanup(self, output_filename):
+    def _cleanup(self, output_filename, input_filename=None):
         """
             Removes the images that have been saved locally and temporarily.
             Removes the input image files and the generated output files.
         """
-        # Remove stored slack image
-        if self.input_filename and os.path.exists(self.input_filename):
-            os.remove(self.input_filename)
-   
-        if output_filename and os.path.exists(output_filename):
-            os.remove(output_filename)
+        # Remove stored slack image. Checkpointed files are kept until the job has finished.
+        for filename in (input_filename, output_filename):
+            if isinstance(filename, str) and not self.checkpoints.owns(filename) and os.path.exists(filename):
+                os.remove(filename)
 
 
 
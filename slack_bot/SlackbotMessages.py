@@ -15,13 +15,20 @@ class SlackBotMessages:
     PromptError = "There must be a flag and a body to this message to give the model direction. Try again using --inject followed by a prompt."
     SeriesError = "When using the --series flag you must specify one or more variable arguments. E.g. {1, 2, 3, 4} somewhere in your message. You must also only include a single image or prompt."
     DropboxError = "File could not be uploaded to DropBox"
-    def GeneratorError(e):
+    JobFailed = "I couldn't finish your request after several attempts, so I've given up on it. Please try again. :warning:"
+    QueueFull = "I'm working on too many requests right now. Please try again in a few minutes. :hourglass:"
+    def GeneratorError(self, e):
        return f"Something went wrong with ImageGeneratorBot :( Image request did not pass the vibe check. {e}"
     
+    def DownloadError(self, e):
+       return f"I couldn't download your image from Slack, so nothing was generated. Please try again. {e}"
+
     def DropboxUploadError(self, e):
        return f"There was an error uploading to Dropbox: {e}"
 
-    def HelpMessage(self, user):
+    def HelpMessage(self, user, fresh=False):
+        # --fresh only does something when the result cache is enabled
+        fresh_flag = "\t--fresh: Always generates a new image, even if I have made one for the same image and prompt before\n" if fresh else ""
         return (f"Hello <@{user}>! :wave:\n\n"
                 "To generate an AI image, please follow these steps:\n"
                 "1. **Mention me** in your message (`@ImageGeneratorBot`).\n"
@@ -30,7 +37,22 @@ class SlackBotMessages:
                 "\t--verbose: Will give you feedback for most of the operations so that you know exactly what I'm doing\n"
                 "\t--inject: Allows you to add a message to your prompt. Just type your message into the box following the flag.\n"
                 "\t--series: Allows you to create a series of images from a single image or prompt\n"
+                f"{fresh_flag}"
                 "I'll handle the rest and create your AI-generated image! :art:")
 
+    def ArchiveProgress(self, done, total):
+        return f"Archived {done} of {total} files..."
+
+    def ArchiveListError(self, e):
+        return f"I couldn't list the files in this channel, so nothing was archived. Please try again. {e}"
+
+    def ArchiveSummary(self, successes, failures, max_listed=20):
+        summary = f"Archive finished: {successes} file(s) uploaded to DropBox, {len(failures)} failed."
+        for failure in failures[:max_listed]:
+            summary += f"\n\t{failure['name']}: {failure['error']}"
+        if len(failures) > max_listed:
+            summary += f"\n\t...and {len(failures) - max_listed} more."
+        return summary
+
     def GeneratorConfirmation(self, filename):
         return f"Slack Bot will send a file with the name {filename} here... :hourglass_flowing_sand:"
\ No newline at end of file
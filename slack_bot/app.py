@@ -1,8 +1,15 @@
 import os
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+import clients # Loads .env before any module reads its settings
 from EventHandler import EventHandler
+from job_queue import JobQueue, QueueFullError
+from dedup import EventDeduplicator
+from job_store import JobStore, DurableJobs
+from vars import CHANNEL_MAP
+from slack_helper import send_message, dispatcher
+from metrics import Gauge, render as render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from SlackbotMessages import SlackBotMessages
 import logging
-import threading
 import time
 import base64
 import hmac
@@ -10,11 +17,8 @@ import hashlib
 import requests
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import unpad
-from dotenv import load_dotenv
 import hashlib, hmac, base64, json, uuid
 
-load_dotenv()
-
 if os.path.exists("app.log"):
     os.remove("app.log")
 
@@ -30,6 +34,46 @@ app = Flask(__name__)
 
 events_of_interest = set({"app_mention"})
 
+EXECUTION_ENGINE = os.getenv("EXECUTION_ENGINE", "threads") # threads, asyncio
+
+# Bounded pool of workers that run the event handlers
+if EXECUTION_ENGINE == "asyncio":
+    # Jobs run as coroutines on one event loop, see async_engine.py
+    from async_engine import AsyncJobQueue
+    from async_handler import AsyncEventHandler
+    job_queue = AsyncJobQueue(app.logger)
+    handler_class = AsyncEventHandler
+else:
+    job_queue = JobQueue(app.logger)
+    handler_class = EventHandler
+
+# Accepted events are written to disk before the ack, and unfinished ones are resumed after a restart
+job_store = JobStore()
+durable_jobs = DurableJobs(
+    job_store,
+    job_queue,
+    lambda payload, job_id: handler_class(app.logger, **payload, job_id=job_id),
+    app.logger,
+    on_dead=lambda payload: send_message(payload["channel_id"], SlackBotMessages.JobFailed),
+    on_dropped=lambda payload: send_message(payload["channel_id"], SlackBotMessages.QueueFull)
+)
+durable_jobs.start()
+
+# Read from the queues and the job store whenever /metrics is scraped
+Gauge("slackbot_queue_depth", "Jobs waiting for a worker.", callback=job_queue.depth)
+Gauge("slackbot_jobs_in_flight", "Jobs being run by a worker.", callback=job_queue.in_flight)
+Gauge(
+    "slackbot_slack_queue_depth", "Slack calls queued or in flight, per channel.", ("channel",),
+    callback=lambda: {(channel,): depth for channel, depth in dispatcher.depths().items()}
+)
+Gauge(
+    "slackbot_job_store_jobs", "Jobs in the durable job store, per state.", ("state",),
+    callback=lambda: {(state,): count for state, count in job_store.counts().items()}
+)
+
+# Remembers accepted events so Slack retries do not trigger a second generation
+deduplicator = EventDeduplicator()
+
 # YOUR APP credentials
 APP_ID = os.getenv("APP_ID")
 APP_SECRET = os.getenv("APP_SECRET")
@@ -123,6 +167,13 @@ def shein_callback():
 def hello():
     return "Hello from Railway!"
 
+@app.route("/metrics")
+def metrics():
+    """
+        Stage latencies, job and retry counters and queue gauges in the Prometheus text format.
+    """
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
 @app.route('/slack/events', methods=['POST', 'GET'])
 def slack_events():
     data = request.get_json()
@@ -142,11 +193,35 @@ def slack_events():
         files = event.get("files")
 
         if event_type in events_of_interest:
-            event_handler = EventHandler(app.logger, event_type, channel_id, user, text, files)
+            if channel_id not in CHANNEL_MAP:
+                app.logger.info(f"Ignoring {event_type} from unconfigured channel: {channel_id}")
+                return '', 200
+
+            if deduplicator.is_duplicate(data):
+                retry_num = request.headers.get("X-Slack-Retry-Num")
+                retry_reason = request.headers.get("X-Slack-Retry-Reason")
+                app.logger.info(f"Ignoring duplicate event {data.get('event_id')} (retry {retry_num}, reason {retry_reason})")
+                return '', 200
+
+            payload = {
+                "event_type": event_type,
+                "channel_id": channel_id,
+                "user": user,
+                "text": text,
+                "files": files
+            }
             app.logger.info(f"{event_type} message from {user}: {text}, channel: {channel_id}")
 
-            # Launch background thread
-            threading.Thread(target=event_handler.handle_event).start()
+            # Store the job, then hand it to the worker pool
+            try:
+                durable_jobs.accept(data.get("event_id") or uuid.uuid4().hex, payload)
+            except QueueFullError:
+                app.logger.warning(f"Job queue full, rejected {event_type} from {user} in channel: {channel_id}")
+                send_message(channel_id, SlackBotMessages.QueueFull)
+            except Exception:
+                # Not stored either, Slack retries the event after the error response
+                deduplicator.forget(data)
+                raise
 
     return '', 200
 
@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import threading
+import time
+
+__all__ = ["ArchiveState"]
+
+ARCHIVE_STATE_PATH = os.getenv("ARCHIVE_STATE_PATH", "archive_state.db")
+
+
+class ArchiveState:
+    """
+        Persists what --archive has already done for each channel.
+            watermarks: the Slack timestamp up to which a channel has been fully archived.
+            archived_files: the manifest of files already copied to Dropbox.
+        The next run only scans messages after the watermark and skips files in the manifest.
+    """
+    def __init__(self, path=ARCHIVE_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks ("
+            "channel_id TEXT PRIMARY KEY, ts REAL, updated_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS archived_files ("
+            "channel_id TEXT, file_key TEXT, name TEXT, archived_at REAL, "
+            "PRIMARY KEY (channel_id, file_key))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def file_key(file):
+        """
+            Slack file ids are stable; fall back to the private url for files without one.
+        """
+        return file.get("id") or file.get("url_private")
+
+    def get_watermark(self, channel_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT ts FROM watermarks WHERE channel_id = ?", (channel_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, channel_id, ts):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO watermarks (channel_id, ts, updated_at) VALUES (?, ?, ?)",
+                (channel_id, ts, time.time())
+            )
+            self._conn.commit()
+
+    def archived_keys(self, channel_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT file_key FROM archived_files WHERE channel_id = ?", (channel_id,)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def mark_archived(self, channel_id, files):
+        """
+            Adds the given files to the channel's manifest.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO archived_files (channel_id, file_key, name, archived_at) VALUES (?, ?, ?, ?)",
+                [(channel_id, self.file_key(file), file.get("name"), now) for file in files]
+            )
+            self._conn.commit()
+
+    def reset(self, channel_id):
+        """
+            Forgets the watermark and manifest of a channel so the next run is a full resync.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM watermarks WHERE channel_id = ?", (channel_id,))
+            self._conn.execute("DELETE FROM archived_files WHERE channel_id = ?", (channel_id,))
+            self._conn.commit()
@@ -1,18 +1,22 @@
 import requests
 import time
 import os
-from dotenv import load_dotenv
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackApiError
-from slack_helper import get_all_channel_ids
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from clients import slack_client
+from slack_helper import get_all_channel_ids, download_slack_file
+from dropbox_helper import upload_batch_to_shared_folder
 from utils import to_unix_timestamp
 
 SLACK_TOKEN = os.getenv("SLACK_TOKEN")
 SLACKBOT_ID = os.getenv("SLACKBOT_ID")
 
-client = WebClient(token=SLACK_TOKEN, timeout=180)
+ARCHIVE_DOWNLOAD_WORKERS = int(os.getenv("ARCHIVE_DOWNLOAD_WORKERS", 8))
+ARCHIVE_UPLOAD_WORKERS = int(os.getenv("ARCHIVE_UPLOAD_WORKERS", 2))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 25)) # Files per Dropbox batch commit
+ARCHIVE_MAX_BUFFERED_BYTES = int(os.getenv("ARCHIVE_MAX_BUFFERED_BYTES", 32 * 1024 ** 2)) # Downloads waiting for upload
+ARCHIVE_PROGRESS_EVERY = int(os.getenv("ARCHIVE_PROGRESS_EVERY", 50))
 
-load_dotenv()
 
 # Function to list all files in a specific Slack channel
 # def list_files_in_channel(channel_id, start_time, end_time):
@@ -48,45 +52,172 @@ load_dotenv()
 #         return None
 
 def list_files_in_channel(channel_id, start_ts, end_ts, filter_by_user_id=SLACKBOT_ID):
-    try:
-        files = []
-        has_more = True
-        next_cursor = None
-
-        while has_more:
-            response = client.conversations_history(
-                channel=channel_id,
-                oldest=start_ts,
-                latest=end_ts,
-                limit=1000,
-                cursor=next_cursor
+    """
+    Lists the files posted in a channel between start_ts and end_ts, optionally only those of one user.
+    Each file carries the ts of the message that shared it as message_ts, the time the history is filtered on;
+    its own timestamp is when it was created, which can be much earlier.
+    Raises SlackApiError if any page of the history could not be read, so a partial listing is never
+    mistaken for the complete one.
+    """
+    files = []
+    has_more = True
+    next_cursor = None
+
+    while has_more:
+        response = slack_client().conversations_history(
+            channel=channel_id,
+            oldest=start_ts,
+            latest=end_ts,
+            limit=1000,
+            cursor=next_cursor
+        )
+
+        messages = response['messages']
+        for msg in messages:
+            if 'files' in msg:
+                for f in msg['files']:
+                    if not filter_by_user_id or f.get('user') == filter_by_user_id:
+                        files.append({
+                            'id': f.get('id'),
+                            'name': f.get('name'),
+                            'size': f.get('size'),
+                            'url_private': f.get('url_private'),
+                            'user': f.get('user'),
+                            'timestamp': f.get('timestamp'),
+                            'message_ts': float(msg['ts']) if msg.get('ts') else None
+                        })
+
+        next_cursor = response.get("response_metadata", {}).get("next_cursor")
+        has_more = bool(next_cursor)
+
+    print(f"Total files found in {channel_id}: {len(files)}")
+    return files
+
+class _ByteBudget:
+    """
+        Bytes of downloaded files allowed on disk at once.
+        A file larger than the whole budget is still let through when nothing else is held.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def reserve(self, size, block=True):
+        """
+            Reserves size bytes, waiting for them when block is set. Returns False when they are not available.
+        """
+        with self._condition:
+            fits = lambda: self.used == 0 or self.used + size <= self.max_bytes
+            if not (self._condition.wait_for(fits) if block else fits()):
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+def archive_files(files, folder_id, output_dir, progress_callback=None):
+    """
+    Copies the given Slack files into a Dropbox folder as a two stage pipeline.
+    Downloads run on ARCHIVE_DOWNLOAD_WORKERS threads and feed batches of ARCHIVE_BATCH_SIZE files
+    to ARCHIVE_UPLOAD_WORKERS upload threads. A download only starts once its size fits in
+    ARCHIVE_MAX_BUFFERED_BYTES, so output_dir (usually tmpfs) never holds more than that.
+    progress_callback(done, total) is called every ARCHIVE_PROGRESS_EVERY files.
+    Returns a list of {"name", "file", "error"} results, one per file; error is None on success.
+    """
+    files = [f for f in files if f.get("name") and f.get("name") != "error" and f.get("url_private")]
+    total = len(files)
+    results = []
+    results_lock = threading.Lock()
+    budget = _ByteBudget(ARCHIVE_MAX_BUFFERED_BYTES)
+
+    def record(file, error=None):
+        with results_lock:
+            results.append({"name": file["name"], "file": file, "error": error})
+            done = len(results)
+        if progress_callback and (done % ARCHIVE_PROGRESS_EVERY == 0 or done == total):
+            progress_callback(done, total)
+
+    def download(index, file):
+        # Prefix with the index so files that share a name do not overwrite each other locally
+        local_path = os.path.join(output_dir, f"{index}-{file['name']}")
+        try:
+            download_slack_file(file["url_private"], local_path, expected_size=file.get("size"))
+        except Exception:
+            budget.release(file.get("size") or 0)
+            raise
+        return local_path
+
+    def upload(batch):
+        try:
+            responses = upload_batch_to_shared_folder(
+                [(local_path, file["name"]) for file, local_path in batch], folder_id
             )
-
-            messages = response['messages']
-            for msg in messages:
-                if 'files' in msg:
-                    for f in msg['files']:
-                        if not filter_by_user_id or f.get('user') == filter_by_user_id:
-                            files.append({
-                                'name': f.get('name'),
-                                'url_private': f.get('url_private'),
-                                'user': f.get('user'),
-                                'timestamp': f.get('timestamp')
-                            })
-
-            next_cursor = response.get("response_metadata", {}).get("next_cursor")
-            has_more = bool(next_cursor)
-
-        print(f"\nTotal Files Found: {len(files)}")
-        for i, file in enumerate(files):
-            if i == 0:
-                print(f"{file['name']} | Uploaded by: {file['user']} | URL: {file['url_private']}")
-
-        return files
-
-    except SlackApiError as e:
-        print(f"Error fetching files: {e.response['error']}")
-        return []
+        except Exception as e:
+            responses = [{"error": str(e)}] * len(batch)
+
+        for (file, local_path), response in zip(batch, responses):
+            error = None
+            try:
+                error = response.get("error")
+                if error:
+                    error = f"{error} {response.get('details', '')}".strip()
+                if os.path.exists(local_path):
+                    os.remove(local_path)
+            except Exception as e:
+                # Still give the file a result, or it would be missing from the summary
+                error = error or str(e)
+            finally:
+                # Always hand the bytes back, or the next reserve() could wait forever
+                budget.release(file.get("size") or 0)
+            record(file, error)
+
+    with ThreadPoolExecutor(ARCHIVE_DOWNLOAD_WORKERS) as downloads, ThreadPoolExecutor(ARCHIVE_UPLOAD_WORKERS) as uploads:
+        pending_downloads = {}
+        pending_uploads = []
+        batch = []
+
+        def submit_upload():
+            nonlocal batch
+            pending_uploads.append(uploads.submit(upload, batch))
+            batch = []
+
+        def collect(done):
+            for future in done:
+                file = pending_downloads.pop(future)
+                try:
+                    batch.append((file, future.result()))
+                except Exception as e:
+                    record(file, str(e))
+
+                if len(batch) >= ARCHIVE_BATCH_SIZE:
+                    submit_upload()
+
+        for index, file in enumerate(files):
+            size = file.get("size") or 0
+            while not budget.reserve(size, block=not (pending_downloads or batch)):
+                # Out of room: hand the finished downloads to the uploaders and wait for a running one
+                if batch:
+                    submit_upload()
+                if pending_downloads:
+                    collect(wait(pending_downloads, return_when=FIRST_COMPLETED).done)
+
+            pending_downloads[downloads.submit(download, index, file)] = file
+            collect([future for future in pending_downloads if future.done()])
+
+        collect(wait(pending_downloads).done)
+        if batch:
+            submit_upload()
+
+        # Raise anything that escaped an upload instead of losing it
+        for future in pending_uploads:
+            future.result()
+
+    return results
 
 # Example Usage
 if __name__ == "__main__":
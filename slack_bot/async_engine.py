@@ -0,0 +1,215 @@
+import os
+import asyncio
+import functools
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import aiohttp
+from job_queue import QueueFullError, STAGE_CONCURRENCY, JOB_QUEUE_MAX_DEPTH
+from metrics import STAGE_WAIT_SECONDS, RETRIES_TOTAL
+from slack_helper import (
+    SlackDownloadError,
+    SLACK_TOKEN,
+    SLACK_POOL_SIZE,
+    SLACK_DOWNLOAD_TIMEOUT,
+    SLACK_DOWNLOAD_RETRIES,
+    SLACK_DOWNLOAD_CHUNK_SIZE,
+    RETRY_STATUSES
+)
+
+__all__ = [
+    "AsyncJobQueue",
+    "async_stage_limit",
+    "run_cpu",
+    "run_blocking",
+    "download_slack_file_async"
+]
+
+ASYNC_MAX_JOBS = int(os.getenv("ASYNC_MAX_JOBS", 200)) # Jobs in flight at once on the event loop
+ASYNC_CPU_WORKERS = int(os.getenv("ASYNC_CPU_WORKERS", os.cpu_count() or 1)) # Threads for resize and encode
+ASYNC_BLOCKING_WORKERS = int(os.getenv("ASYNC_BLOCKING_WORKERS", 8)) # Threads for helpers without an async client
+
+# CPU bound work (resize, PNG encode, hashing) runs here so the event loop never stalls on it
+cpu_executor = ThreadPoolExecutor(ASYNC_CPU_WORKERS, thread_name_prefix="async-cpu")
+# Blocking helpers that have no async client yet (Dropbox, the archive pipeline)
+blocking_executor = ThreadPoolExecutor(ASYNC_BLOCKING_WORKERS, thread_name_prefix="async-blocking")
+
+_stage_limits = {}
+_http_session = None
+
+
+@asynccontextmanager
+async def async_stage_limit(stage):
+    """
+        The asyncio counterpart of job_queue.stage_limit, with the same per-stage limits.
+        Unknown stages are not limited.
+    """
+    if stage not in STAGE_CONCURRENCY:
+        yield
+        return
+
+    if stage not in _stage_limits:
+        _stage_limits[stage] = asyncio.Semaphore(STAGE_CONCURRENCY[stage])
+
+    start = time.perf_counter()
+    async with _stage_limits[stage]:
+        STAGE_WAIT_SECONDS.observe(time.perf_counter() - start, stage=stage)
+        yield
+
+
+async def run_cpu(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run_blocking(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, functools.partial(fn, *args, **kwargs))
+
+
+def _session():
+    """
+        Keep-alive connections shared by every download on the event loop.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=SLACK_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(sock_connect=SLACK_DOWNLOAD_TIMEOUT[0], sock_read=SLACK_DOWNLOAD_TIMEOUT[1])
+        )
+    return _http_session
+
+
+async def download_slack_file_async(file_url, destination, token=SLACK_TOKEN, expected_size=None, expected_sha256=None):
+    """
+        The asyncio version of slack_helper.download_slack_file, with the same checks.
+        Streams a private Slack file to a local path or a writable binary buffer and returns the bytes written.
+        Each attempt holds a "slack" stage slot, which is released before waiting to retry.
+        Raises SlackDownloadError if the file could not be downloaded.
+    """
+    headers = {
+        "Authorization": f"Bearer {token}"
+    }
+    last_error = None
+
+    for attempt in range(SLACK_DOWNLOAD_RETRIES + 1):
+        digest = hashlib.sha256()
+        written = 0
+        delay = 2 ** attempt
+        out = destination if hasattr(destination, "write") else open(f"{destination}.part", "wb")
+        try:
+            out.seek(0)
+            out.truncate()
+            async with async_stage_limit("slack"), _session().get(file_url, headers=headers) as response:
+                if response.status in RETRY_STATUSES:
+                    delay = float(response.headers.get("Retry-After") or delay)
+                    raise aiohttp.ClientResponseError(
+                        response.request_info, response.history, status=response.status, message=response.reason
+                    )
+                if response.status != 200:
+                    raise SlackDownloadError(f"Failed to download: {response.status}, {response.reason}")
+
+                # Slack answers an expired or unauthorised file url with an HTML login page
+                if response.headers.get("Content-Type", "").startswith("text/html"):
+                    raise SlackDownloadError("Failed to download: Slack returned a login page instead of the file")
+
+                async for chunk in response.content.iter_chunked(SLACK_DOWNLOAD_CHUNK_SIZE):
+                    out.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+
+            if expected_size is not None and written != expected_size:
+                raise aiohttp.ClientPayloadError(f"Size mismatch: expected {expected_size} bytes, got {written}")
+            if expected_sha256 and digest.hexdigest() != expected_sha256:
+                raise aiohttp.ClientPayloadError("Checksum mismatch")
+
+            if hasattr(destination, "write"):
+                destination.seek(0)
+            else:
+                out.close()
+                os.replace(f"{destination}.part", destination)
+            print(f"Saved to {destination if isinstance(destination, str) else 'buffer'} ({written} bytes)")
+            return written
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            last_error = e
+            print(f"Download attempt {attempt + 1} failed: {e}")
+            if attempt < SLACK_DOWNLOAD_RETRIES:
+                RETRIES_TOTAL.inc(service="slack_download")
+                await asyncio.sleep(delay)
+        finally:
+            if out is not destination:
+                out.close()
+                if os.path.exists(f"{destination}.part"):
+                    os.remove(f"{destination}.part")
+
+    raise SlackDownloadError(f"Failed to download after {SLACK_DOWNLOAD_RETRIES + 1} attempts: {last_error}")
+
+
+class AsyncJobQueue:
+    """
+        Runs coroutine jobs on an event loop in a background thread, so hundreds of jobs that mostly wait on
+        HTTP can be in flight without an OS thread each. It has the same interface as JobQueue:
+        at most max_jobs run at once, up to max_depth more wait for a slot and any beyond that are refused
+        with a QueueFullError.
+    """
+    runs_coroutines = True
+
+    def __init__(self, logger, max_jobs=ASYNC_MAX_JOBS, max_depth=JOB_QUEUE_MAX_DEPTH):
+        self.logger = logger
+        self.max_jobs = max_jobs
+        self.max_depth = max_depth
+
+        self.loop = None
+        self._slots = None
+        self._waiting = 0
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+            Starts the event loop thread. Calling start more than once has no effect.
+        """
+        with self._lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self._slots = asyncio.Semaphore(self.max_jobs)
+            thread = threading.Thread(target=self.loop.run_forever, name="async-engine", daemon=True)
+            thread.start()
+
+    def submit(self, job, *args, **kwargs):
+        """
+            Schedules the coroutine function job(*args, **kwargs) on the event loop.
+            Raises QueueFullError if the job could not be accepted.
+        """
+        self.start()
+        with self._lock:
+            if self._running + self._waiting >= self.max_jobs + self.max_depth:
+                raise QueueFullError("Job queue is full")
+            self._waiting += 1
+        return asyncio.run_coroutine_threadsafe(self._run(job, args, kwargs), self.loop)
+
+    def depth(self):
+        """
+            Returns the number of jobs waiting for a slot.
+        """
+        with self._lock:
+            return self._waiting
+
+    def in_flight(self):
+        with self._lock:
+            return self._running
+
+    async def _run(self, job, args, kwargs):
+        async with self._slots:
+            with self._lock:
+                self._waiting -= 1
+                self._running += 1
+            try:
+                await job(*args, **kwargs)
+            except Exception as e:
+                self.logger.error(f"Job failed: {e}")
+            finally:
+                with self._lock:
+                    self._running -= 1
@@ -0,0 +1,251 @@
+import os
+import asyncio
+from EventHandler import (
+    EventHandler,
+    messages,
+    SERIES_MAX_CONCURRENCY,
+    SLACK_DELIVERY_TIMEOUT,
+    result_cache
+)
+from slack_helper import send_message, SlackDownloadError
+from generate_prompt import generate_prompt_async
+from generate_image import generate_image_async, edit_image_async
+from workspace import JobWorkspace
+from progress import StatusMessage
+from metrics import track_stage
+from async_engine import async_stage_limit, run_cpu, run_blocking, download_slack_file_async
+
+__all__ = ["AsyncEventHandler"]
+
+
+class AsyncEventHandler(EventHandler):
+    """
+        The EventHandler pipeline as coroutines, run by the AsyncJobQueue.
+        Only the waits differ: Slack downloads and OpenAI calls use async clients, and every other stage
+        runs EventHandler's own code on the CPU executor (resize, encode, hashing) or the blocking executor
+        (Dropbox, checkpoints, the result cache), so no disk or SQLite call runs on the event loop.
+        Flags, messages and outputs are the same as EventHandler's.
+    """
+    async def handle_event(self):
+        """
+            Delegates the handling of the message to the specified function.
+            The job runs inside its own workspace which is removed when the job ends.
+        """
+        self.status = StatusMessage(self.channel_id)
+        try:
+            self.workspace = await run_blocking(JobWorkspace)
+            try:
+                self.logger.info(f"Job workspace: {self.workspace.root}")
+                if self.event_type == "app_mention":
+                    self.logger.info("Handling app_mention...")
+                    await self._handle_app_mention()
+                elif self.event_type == "file_shared":
+                    await self._handle_files_shared()
+            finally:
+                await run_blocking(self.workspace.close)
+            await self._finish_stages()
+        finally:
+            self.status.close()
+            if self.job_id is None:
+                await run_blocking(self.checkpoints.clear)
+
+    async def _finish_stages(self):
+        for stage, delivery in self.deliveries:
+            try:
+                await asyncio.wait_for(asyncio.wrap_future(delivery), SLACK_DELIVERY_TIMEOUT)
+                await run_blocking(self.checkpoints.save, stage)
+            except Exception as e:
+                self.failed_stages.append(f"{stage} ({e})")
+
+        await run_blocking(self._close_stages)
+
+    async def _handle_app_mention(self):
+        if self.help: # If the help flag is present
+            message = messages.HelpMessage(self.user, fresh=result_cache is not None)
+            send_message(self.channel_id, message)
+
+        if self.archive and self.allow_archive:
+            # The archive already runs its own download and upload pools
+            await run_blocking(self._handle_archive)
+
+        if self.series and not self._read_series_params():
+            return
+
+        if self.files: # The user has submitted a file to be edited
+            await self._handle_files_shared()
+        else: # The user has not submitted a file to be edited
+            await self._handle_direct_prompt()
+
+    async def _handle_files_shared(self):
+        self.mode = "image-edit"
+        for file in self.files:
+            await self._handle_file_shared(file)
+
+    async def _handle_file_shared(self, file):
+        ext = self._select_input(file)
+
+        if self.reformat:
+            self.input_filename = await self._get_file_from_user(file, ext)
+            if not self.input_filename:
+                return
+            # Just reformat the image and send it, encoded as PNG like every other output
+            output_filename = self._name_output(self._input_stem())
+
+            await self._handle_image_reformatting(output_filename)
+            await run_blocking(self._cleanup, output_filename, self.input_filename)
+            return
+
+        # SERIES Handling
+        if self.series:
+            # Fetch the seed once, every variant edits the same read-only bytes
+            seed_image = await self._get_file_from_user(file, ext, in_memory=True)
+            if seed_image is None:
+                return
+            stem = JobWorkspace.unique_stem()
+
+            await self._run_series(
+                lambda series_index: self._facilitate_output(f"{stem}-{series_index + 1}", series_index, seed_image)
+            )
+
+        else:
+            self.input_filename = await self._get_file_from_user(file, ext)
+            if not self.input_filename:
+                return
+            await self._facilitate_output(self._input_stem(), input_image=self.input_filename)
+
+    async def _handle_direct_prompt(self):
+        if not self.inject:
+            self.logger.error("No valid message body.")
+            send_message(self.channel_id, messages.PromptError)
+            return
+
+        self.mode = "prompt-only"
+        self.input_key = "prompt"
+
+        # SERIES Handling
+        if self.series:
+            await self._run_series(lambda series_index: self._facilitate_output(JobWorkspace.unique_stem(), series_index))
+        else:
+            await self._facilitate_output(JobWorkspace.unique_stem())
+
+    async def _run_series(self, run_variant):
+        """
+            Runs the coroutine run_variant(series_index) for every variant of the series concurrently,
+            within the same per-job and global limits as EventHandler._run_series.
+        """
+        count = len(self.series_params[0])
+        job_limit = asyncio.Semaphore(max(1, min(SERIES_MAX_CONCURRENCY, count)))
+
+        async def run_limited(series_index):
+            async with job_limit, async_stage_limit("series"):
+                await run_variant(series_index)
+
+        results = await asyncio.gather(*(run_limited(i) for i in range(count)), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.error(f"Series variant failed: {result}")
+
+        await run_blocking(self._flush_pending_uploads)
+
+    async def _facilitate_output(self, stem, series_index=None, input_image=None):
+        output_filename = self._name_output(stem)
+
+        self._report(messages.VerboseConfirmation)
+
+        await self._generate_image_and_send(output_filename, series_index, input_image)
+
+    async def _get_file_from_user(self, file, ext, in_memory=False):
+        stage = f"download:{self.input_key}"
+        resumed = await run_blocking(self._resumed_input, stage, ext, in_memory)
+        if resumed is not None:
+            return resumed
+
+        destination = await run_blocking(self._input_destination, ext, in_memory)
+
+        try:
+            # The download takes the slack slot per attempt, so its retry waits do not hold one
+            with track_stage("download"):
+                await download_slack_file_async(file["url_private"], destination, expected_size=file.get("size"))
+        except SlackDownloadError as e:
+            return self._download_failed(file, e)
+
+        return await run_blocking(self._record_input, stage, destination)
+
+    async def _generate_image_and_send(self, output_filename, series_index=None, input_image=None):
+        output = await self._handle_image_prompt_and_generation(output_filename, series_index, input_image)
+        if output is None:
+            return
+
+        await run_blocking(self._send_output, output, output_filename, series_index, input_image)
+
+    async def _handle_image_prompt_and_generation(self, output_filename, series_index=None, input_image=None):
+        key = self._output_key(series_index)
+        try:
+            output = await run_blocking(self._resumed_output, key)
+            if output is not None:
+                return output
+
+            generated_prompt = self.checkpoints.get(f"prompt:{key}")
+            if generated_prompt is None:
+                generated_prompt = await self._generate_prompt(self.mode, series_index)
+                await run_blocking(self.checkpoints.save, f"prompt:{key}", generated_prompt)
+
+            cache_key, output = await run_cpu(self._cached_result, generated_prompt, input_image, output_filename)
+            if output is not None:
+                return output
+
+            generated_image = await run_blocking(self.checkpoints.read, f"generate:{key}")
+            if generated_image is None:
+                generated_image = await self._generate_image(self.mode, generated_prompt, input_image)
+                await run_blocking(self._checkpoint_generation, key, generated_image)
+
+            return await run_cpu(self._finish_output, key, generated_image, output_filename, cache_key)
+
+        except Exception as e:
+            self._generation_failed(e)
+
+    async def _generate_prompt(self, mode, series_index=None):
+        text = self._injection_text(series_index)
+
+        # Get the dense prompt
+        if mode == "prompt-only":
+            # This will only run if inject is true as it's being handled in the parent function
+            async with async_stage_limit("openai"):
+                with track_stage("prompt"):
+                    generated_prompt = await generate_prompt_async(mode="prompt-only", injection=text)
+
+        if mode == "image-edit":
+            # Just return the boilerplate prompt
+            with track_stage("prompt"):
+                generated_prompt = await generate_prompt_async(mode="image-edit")
+
+        return self._prompt_generated(mode, generated_prompt, text)
+
+    async def _generate_image(self, mode, generated_prompt, input_image=None):
+        # Make a call to OpenAi image generation model based on the prompt
+        async with async_stage_limit("openai"):
+            with track_stage("generate") as run:
+                if mode == "prompt-only":
+                    generated_image = await generate_image_async(self.logger, generated_prompt)
+
+                if mode == "image-edit":
+                    generated_image = await edit_image_async(self.logger, generated_prompt, input_image, self.input_name)
+
+                if isinstance(generated_image, dict) and generated_image.get("error"):
+                    run.fail()
+
+        return self._image_generated(generated_image)
+
+    async def _handle_image_reformatting(self, output_filename):
+        key = self._output_key()
+        file_name = os.path.basename(output_filename)
+
+        output = await run_blocking(self._checkpointed_output, key)
+        if output is None:
+            output = await run_cpu(self._reformat_input, key, file_name)
+
+        # Send the output to dropbox
+        await run_blocking(self._upload_to_dropbox, key, output, file_name)
+
+        # Send the output to slack
+        self._deliver(key, output, file_name, message="Here's your reformatted image!")
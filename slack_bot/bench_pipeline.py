@@ -0,0 +1,399 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from fake_services import FakeServices, SERVICES
+
+JOB_KINDS = ("single", "edit", "series", "reformat", "archive")
+DEFAULT_MIX = "single=3,edit=3,series=1,reformat=2,archive=1"
+BENCH_CHANNELS = [f"CBENCH{n}" for n in range(1, 8)] # vars.py reads up to seven channels
+BOT_USER = "UBENCHBOT"
+SERIES_WORDS = ["red", "green", "blue", "gold", "violet", "teal", "amber", "coral", "ivory", "jade"]
+
+# Limits high enough that the bench measures the pipeline rather than the production rate limits
+UNLIMITED = {
+    "OPENAI_RATE_LIMITS": json.dumps({model: {"rpm": 100000, "ipm": 100000} for model in ("gpt-image-1", "dall-e-2", "gpt-4o")}),
+    "SLACK_RATE_LIMITS": json.dumps({method: 100000 for method in ("chat_postMessage", "chat_update", "files_upload_v2")}),
+    "SLACK_CHANNEL_INTERVAL": "0",
+}
+
+
+def parse_pairs(value, cast=float):
+    """
+    Parses "name=value,name=value" into a dict.
+    """
+    pairs = {}
+    for item in filter(None, (value or "").split(",")):
+        name, _, number = item.partition("=")
+        pairs[name.strip()] = cast(number)
+    return pairs
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile of values, q between 0 and 100.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def configure_environment(services, args):
+    """
+    Points every client at the stand-ins and gives the bot a set of channels to work in.
+    Settings the bot reads at import are set here, before any of its modules is imported.
+    """
+    urls = services.urls
+    os.environ.update({
+        "SLACK_TOKEN": "xoxb-bench",
+        "SLACK_API_URL": urls["slack"] + "/api/",
+        "SLACKBOT_ID": BOT_USER,
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_BASE_URL": urls["openai"] + "/v1",
+        "DROPBOX_API_URL": urls["dropbox"],
+        "DROPBOX_CONTENT_URL": urls["dropbox"],
+        "DROPBOX_APP_KEY": "bench",
+        "DROPBOX_APP_SECRET": "bench",
+        "DROPBOX_REFRESH_TOKEN": "bench",
+        "DROPBOX_USER_ID": "dbmid:bench",
+    })
+    for n, channel in enumerate(BENCH_CHANNELS, start=1):
+        os.environ[f"VALID_CHANNEL_{n}"] = channel
+        os.environ[f"DROPBOX_{n}"] = f"ns{n}"
+
+    # Every job is distinct, the result cache would only measure cache hits
+    os.environ.setdefault("RESULT_CACHE_ENABLED", "0")
+    os.environ.setdefault("JOB_RESUME_INTERVAL", "2")
+    if not args.production_limits:
+        for name, value in UNLIMITED.items():
+            os.environ.setdefault(name, value)
+
+
+def build_payloads(args, services):
+    """
+    The app_mention events of the run, with the job kinds interleaved according to the mix
+    and spread over the bench channels.
+    """
+    mix = parse_pairs(args.mix, int)
+    unknown = set(mix) - set(JOB_KINDS)
+    if unknown:
+        raise SystemExit(f"Unknown job kinds: {', '.join(sorted(unknown))}")
+    cycle = [kind for kind in JOB_KINDS for _ in range(mix.get(kind, 0))]
+    if not cycle:
+        raise SystemExit("The job mix is empty")
+
+    files_url = services.urls["slack_files"]
+    series = ", ".join(SERIES_WORDS[:args.series_size])
+    payloads = []
+    for i in range(args.jobs):
+        kind = cycle[i % len(cycle)]
+        file = {
+            "id": f"FINPUT{i}",
+            "name": f"input_{i}.png",
+            "filetype": "png",
+            "size": services.image_size,
+            "url_private": f"{files_url}/files/FINPUT{i}/input_{i}.png",
+        }
+        text, files = {
+            "single": (f"<@{BOT_USER}> --inject a watercolour fox, variant {i}", []),
+            "edit": (f"<@{BOT_USER}> --inject add a party hat, variant {i}", [file]),
+            "series": (f"<@{BOT_USER}> --series --inject a {{{series}}} fox, variant {i}", []),
+            "reformat": (f"<@{BOT_USER}> --reformat", [file]),
+            "archive": (f"<@{BOT_USER}> --archive --resync", []),
+        }[kind]
+        payloads.append((kind, {
+            "event_type": "app_mention",
+            "channel_id": BENCH_CHANNELS[i % args.channels],
+            "user": "UBENCHUSER",
+            "text": text,
+            "files": files,
+        }))
+    return payloads
+
+
+def allow_archive(handler):
+    # Archiving is switched off in production by a flag on the handler
+    handler.allow_archive = True
+    return handler
+
+
+def run_handlers(payloads, concurrency, logger):
+    """
+    Runs each job's EventHandler directly, concurrency jobs at a time.
+    Returns the duration and outcome of each job.
+    """
+    from EventHandler import EventHandler
+
+    def run(kind, payload):
+        start = time.perf_counter()
+        try:
+            allow_archive(EventHandler(logger, **payload)).handle_event()
+            outcome = "done"
+        except Exception as e:
+            print(f"{kind} job failed: {e}", file=sys.__stderr__)
+            outcome = "failed"
+        return kind, time.perf_counter() - start, outcome
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(lambda job: run(*job), payloads))
+
+
+def run_app(payloads, rate, timeout, samples):
+    """
+    Posts each job to /slack/events as Slack would, then waits until the job store has finished every accepted job.
+    Returns the duration and outcome of each job attempt and the ack latency of each event.
+    """
+    import app as bot
+    from metrics import JOBS_TOTAL
+
+    build_handler = bot.durable_jobs.build_handler
+    bot.durable_jobs.build_handler = lambda payload, job_id: allow_archive(build_handler(payload, job_id))
+    client = bot.app.test_client()
+    acks = []
+
+    for i, (_, payload) in enumerate(payloads):
+        event = {
+            "type": "event_callback",
+            "event_id": f"Ev{uuid.uuid4().hex[:12].upper()}",
+            "event": {
+                "type": payload["event_type"],
+                "user": payload["user"],
+                "text": payload["text"],
+                "channel": payload["channel_id"],
+                "files": payload["files"],
+            }
+        }
+        start = time.perf_counter()
+        response = client.post("/slack/events", json=event)
+        acks.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            print(f"Event {i} was answered with {response.status_code}", file=sys.__stderr__)
+        if rate:
+            time.sleep(max(0.0, 1 / rate - acks[-1]))
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        counts = bot.job_store.counts()
+        rejected = JOBS_TOTAL.snapshot().get(("rejected",), 0)
+        if counts["done"] + counts["dead"] + rejected >= len(payloads):
+            break
+        time.sleep(0.2)
+    else:
+        print(f"Timed out with jobs unfinished: {bot.job_store.counts()}", file=sys.__stderr__)
+
+    jobs = [("all", seconds, outcome) for outcome in ("done", "retry", "dead") for seconds in samples["slackbot_job_seconds", outcome]]
+    jobs += [("all", 0.0, "rejected")] * int(JOBS_TOTAL.snapshot().get(("rejected",), 0))
+    return jobs, acks
+
+
+def report(args, payloads, jobs, acks, wall, samples, services, rss):
+    """
+    Builds the report of a run: throughput, job and stage latency percentiles, retries and peak memory.
+    """
+    from metrics import RETRIES_TOTAL, STAGE_TOTAL
+
+    finished = [job for job in jobs if job[2] in ("done", "failed", "dead", "rejected")]
+    outcomes = defaultdict(int)
+    for _, _, outcome in jobs:
+        outcomes[outcome] += 1
+
+    stage_errors = defaultdict(int)
+    for (stage, outcome), count in STAGE_TOTAL.snapshot().items():
+        if outcome == "error":
+            stage_errors[stage] += count
+
+    stages = {}
+    for (name, stage), values in sorted(samples.items()):
+        if name == "slackbot_stage_seconds":
+            stages[stage] = {**summarize(values), "errors": stage_errors.get(stage, 0)}
+        elif name == "slackbot_stage_wait_seconds":
+            stages[f"wait:{stage}"] = {**summarize(values), "errors": 0}
+
+    kinds = defaultdict(int)
+    for kind, _ in payloads:
+        kinds[kind] += 1
+
+    return {
+        "target": args.target,
+        "engine": os.getenv("EXECUTION_ENGINE", "threads"),
+        "jobs": len(payloads),
+        "mix": dict(kinds),
+        "wall_seconds": wall,
+        "jobs_per_sec": len(payloads) / wall if wall else None,
+        "outcomes": dict(outcomes),
+        "job_seconds": summarize([seconds for _, seconds, outcome in finished if outcome == "done"]),
+        "ack_seconds": summarize(acks) if acks else None,
+        "stages": stages,
+        "retries": {key[0]: value for key, value in RETRIES_TOTAL.snapshot().items()},
+        "services": services.stats(),
+        "latency": services.latency,
+        "errors": services.errors,
+        "rss_after_import_mb": rss[0] / 1e6,
+        "peak_rss_mb": rss[1] / 1e6,
+    }
+
+
+def print_report(result):
+    def ms(value):
+        return f"{value * 1000:>9.1f}" if value is not None else f"{'-':>9}"
+
+    mix = ", ".join(f"{kind} {count}" for kind, count in result["mix"].items())
+    print(f"\n{result['target']} target, {result['engine']} engine, {result['jobs']} jobs ({mix})")
+    print(f"wall {result['wall_seconds']:.1f}s, {result['jobs_per_sec']:.2f} jobs/sec, outcomes {result['outcomes']}")
+    print(f"peak RSS {result['peak_rss_mb']:.0f} MB ({result['rss_after_import_mb']:.0f} MB after imports)\n")
+
+    print(f"{'latency (ms)':<22} {'count':>6} {'errors':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    rows = [("job", {**result["job_seconds"], "errors": result["outcomes"].get("failed", 0) + result["outcomes"].get("dead", 0)})]
+    if result["ack_seconds"]:
+        rows.append(("ack /slack/events", {**result["ack_seconds"], "errors": 0}))
+    rows += list(result["stages"].items())
+    for name, stats in rows:
+        print(f"{name[:22]:<22} {stats['count']:>6} {stats['errors']:>6} "
+              f"{ms(stats['p50'])} {ms(stats['p95'])} {ms(stats['p99'])} {ms(stats['max'])}")
+
+    print(f"\nretries: {result['retries'] or 'none'}")
+    print(f"stand-in requests: {result['services']}")
+
+
+def compare(result, baseline, threshold):
+    """
+    Prints the changes against an earlier report and returns the regressions larger than threshold (a fraction).
+    """
+    regressions = []
+
+    def check(name, new, old, higher_is_worse=True):
+        if not new or not old:
+            return
+        change = (new - old) / old
+        worse = change > threshold if higher_is_worse else change < -threshold
+        print(f"{name:<30} {old:>10.3f} -> {new:>10.3f} ({change:+.0%}){'  REGRESSION' if worse else ''}")
+        if worse:
+            regressions.append(name)
+
+    print(f"\ncompared with the baseline (threshold {threshold:.0%}):")
+    check("jobs/sec", result["jobs_per_sec"], baseline.get("jobs_per_sec"), higher_is_worse=False)
+    check("peak RSS MB", result["peak_rss_mb"], baseline.get("peak_rss_mb"))
+    check("job p95 s", result["job_seconds"]["p95"], (baseline.get("job_seconds") or {}).get("p95"))
+    for stage, stats in result["stages"].items():
+        old = baseline.get("stages", {}).get(stage)
+        # Too few samples make a p95 meaningless
+        if old and stats["count"] >= 5 and old["count"] >= 5:
+            check(f"{stage} p95 s", stats["p95"], old["p95"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the bot end to end against local stand-ins for Slack, OpenAI and Dropbox and report "
+                    "throughput, stage latency and peak memory. No real API is called."
+    )
+    parser.add_argument("--target", choices=("handler", "app"), default="handler",
+                        help="Drive EventHandler directly, or post events to /slack/events through the job store and queue")
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Relative share of each job kind ({', '.join(JOB_KINDS)})")
+    parser.add_argument("--concurrency", type=int, default=4, help="Jobs run at once by the handler target")
+    parser.add_argument("--rate", type=float, default=0, help="Events posted per second by the app target, 0 for all at once")
+    parser.add_argument("--channels", type=int, default=len(BENCH_CHANNELS), choices=range(1, len(BENCH_CHANNELS) + 1),
+                        metavar=f"1-{len(BENCH_CHANNELS)}", help="Channels the jobs are spread over")
+    parser.add_argument("--series-size", type=int, default=3, choices=range(1, len(SERIES_WORDS) + 1),
+                        metavar=f"1-{len(SERIES_WORDS)}", help="Variants of each --series job")
+    parser.add_argument("--archive-files", type=int, default=50, help="Files found by each --archive job")
+    parser.add_argument("--latency", default="", help=f"Mean latency in seconds per stand-in, e.g. openai_images=8 ({', '.join(SERVICES)})")
+    parser.add_argument("--errors", default="", help="Share of requests failed with a 429 or 503 per stand-in, e.g. openai_images=0.05")
+    parser.add_argument("--production-limits", action="store_true",
+                        help="Keep the production OpenAI and Slack rate limits instead of lifting them")
+    parser.add_argument("--timeout", type=float, default=900, help="Seconds to wait for the app target to finish")
+    parser.add_argument("--json", help="Also write the report to this file")
+    parser.add_argument("--compare", help="A report written by an earlier --json run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.15,
+                        help="With --compare, exit with status 1 if a metric is this much worse")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's own output")
+    args = parser.parse_args()
+
+    latency, errors = parse_pairs(args.latency), parse_pairs(args.errors)
+    unknown = (set(latency) | set(errors)) - set(SERVICES)
+    if unknown:
+        raise SystemExit(f"Unknown stand-ins: {', '.join(sorted(unknown))}")
+
+    services = FakeServices(latency, errors, archive_files=args.archive_files, bot_user=BOT_USER)
+    services.start()
+    here = os.path.dirname(os.path.abspath(__file__))
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix="slackbot-bench-")
+
+    try:
+        configure_environment(services, args)
+        # Job store, checkpoints, caches and the log all use relative paths, keep them out of the repo
+        os.chdir(scratch)
+        sys.path.insert(0, here)
+
+        import metrics
+        from reformat_image import _process_max_rss_bytes
+        from slack_helper import dispatcher
+
+        samples = defaultdict(list)
+        metrics.add_observer(lambda name, labels, value: samples[name, next(iter(labels.values()), None)].append(value))
+
+        payloads = build_payloads(args, services)
+        logger = logging.getLogger("bench")
+        if not args.verbose:
+            # Expected pipeline errors (e.g. an --archive without a prompt) are not news
+            logger.addHandler(logging.NullHandler())
+            logger.propagate = False
+        quiet = open(os.devnull, "w")
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(quiet)
+
+        with output:
+            if args.target == "app":
+                import app # noqa: F401 starts the job queue and the job store
+            rss_after_import = _process_max_rss_bytes()
+            print(f"Running {len(payloads)} jobs against {services.urls}", file=sys.__stderr__)
+
+            start = time.perf_counter()
+            if args.target == "handler":
+                jobs, acks = run_handlers(payloads, args.concurrency, logger), []
+            else:
+                jobs, acks = run_app(payloads, args.rate, args.timeout, samples)
+            wall = time.perf_counter() - start
+            # Status edits still queued are part of the load, but not of the jobs' time
+            dispatcher.wait_idle(timeout=60)
+
+        result = report(args, payloads, jobs, acks, wall, samples, services, (rss_after_import, _process_max_rss_bytes()))
+    finally:
+        os.chdir(cwd)
+        services.stop()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
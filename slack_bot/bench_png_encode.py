@@ -0,0 +1,65 @@
+import argparse
+import os
+import pathlib
+import time
+from PIL import Image
+from png_encoder import ENCODER_PROFILES, encode_png
+from reformat_image import resize_image
+
+PRINT_SIZE = (4500, 5400)
+
+
+def load_images(paths):
+    """
+    Loads the benchmark inputs. Generator outputs that are not yet at print size are resized first
+    so the benchmark encodes what the bot actually sends.
+    """
+    images = []
+    for path in paths:
+        path = pathlib.Path(path)
+        files = sorted(p for p in path.iterdir() if p.suffix.lower() == ".png") if path.is_dir() else [path]
+        for file in files:
+            image = Image.open(file)
+            image.load()
+            if image.size != PRINT_SIZE:
+                image = resize_image(image)
+            images.append((file.name, image))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare PNG encode time and output size for each encoder profile.")
+    parser.add_argument("paths", nargs="*", default=["image_outputs"], help="PNG files or folders of bot outputs")
+    parser.add_argument("--repeat", type=int, default=3, help="Encodes per image, the fastest is reported")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1, help="Threads for the parallel encoder")
+    args = parser.parse_args()
+
+    images = load_images(args.paths)
+    if not images:
+        print("No PNG images found.")
+        return
+
+    print(f"{'image':<40} {'encoder':<9} {'profile':<9} {'seconds':>8} {'MB':>8}")
+    totals = {}
+    for name, image in images:
+        for encoder in ("pillow", "parallel"):
+            for profile in ENCODER_PROFILES:
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    size = len(encode_png(image, profile=profile, encoder=encoder, threads=args.threads).getbuffer())
+                    timings.append(time.perf_counter() - start)
+
+                seconds = min(timings)
+                total = totals.setdefault((encoder, profile), [0, 0])
+                total[0] += seconds
+                total[1] += size
+                print(f"{name[:40]:<40} {encoder:<9} {profile:<9} {seconds:>8.2f} {size / 1e6:>8.2f}")
+
+    print(f"\n{'average':<40} {'encoder':<9} {'profile':<9} {'seconds':>8} {'MB':>8}")
+    for (encoder, profile), (seconds, size) in totals.items():
+        print(f"{'':<40} {encoder:<9} {profile:<9} {seconds / len(images):>8.2f} {size / len(images) / 1e6:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from ttl_cache import SqliteStore
+from job_store import JOB_STORE_PATH, JOB_STORE_RETENTION
+from workspace import default_scratch_dir
+
+__all__ = ["Checkpoints", "StageError"]
+
+# Next to the job workspaces by default; a directory on a persistent volume also survives a restart of the host
+CHECKPOINT_DIR = os.getenv("CHECKPOINT_DIR") or os.path.join(default_scratch_dir(), "slackbot-checkpoints")
+
+
+class StageError(Exception):
+    """
+        Raised at the end of a job when some of its stages failed and the job should be retried from them.
+    """
+
+
+def _safe_name(name):
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in name)
+
+
+class Checkpoints:
+    """
+        The completed stages of one job and their artifacts, kept until the job finishes so a retry
+        starts at the first stage that has not completed.
+        Stage values are small JSON values (a prompt, True) stored next to the job in the job store;
+        artifacts (the downloaded input, the generated image, the encoded output) are files in a
+        directory of their own under CHECKPOINT_DIR.
+        Only a job in the job store can be retried, so a job without an id keeps its stages in memory
+        and no artifacts. keep_files=False keeps no artifacts for a stored job either: its retry
+        downloads and generates again.
+    """
+    def __init__(self, job_id=None, keep_files=True, directory=CHECKPOINT_DIR, path=JOB_STORE_PATH):
+        self.job_id = job_id
+        self.keeps_files = job_id is not None and keep_files # Whether artifacts are written to directory
+        self.directory = os.path.join(directory, _safe_name(job_id)) if self.keeps_files else None
+        self._store = SqliteStore(path, table="checkpoints", ttl=JOB_STORE_RETENTION) if job_id is not None else None
+        self._lock = threading.Lock()
+        self._stages = self._store.get(self.job_id, {}) if self._store is not None else {}
+
+    def get(self, stage):
+        """
+            Returns the value saved for a completed stage, or None.
+        """
+        with self._lock:
+            return self._stages.get(stage)
+
+    def done(self, stage):
+        return self.get(stage) is not None
+
+    def save(self, stage, value=True):
+        """
+            Marks the stage complete with its value.
+        """
+        with self._lock:
+            self._stages[stage] = value
+            if self._store is not None:
+                self._store.set(self.job_id, self._stages)
+
+    def path(self, name):
+        """
+            Returns a path for an artifact in this job's checkpoint directory. Only used when keeps_files is set.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, _safe_name(name))
+
+    def owns(self, path):
+        return self.keeps_files and isinstance(path, str) and os.path.abspath(path).startswith(os.path.abspath(self.directory) + os.sep)
+
+    def file(self, stage):
+        """
+            Returns the artifact path of a completed stage, or None if it is missing.
+        """
+        value = self.get(stage)
+        if isinstance(value, dict) and os.path.exists(value.get("path", "")):
+            return value["path"]
+        return None
+
+    def read(self, stage):
+        """
+            Returns the bytes of a completed stage's artifact, or None.
+        """
+        path = self.file(stage)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def save_file(self, stage, name, artifact):
+        """
+            Stores an artifact given as bytes, a binary buffer or a file path and marks the stage complete.
+            Returns the artifact's checkpoint path, or None when the job keeps no artifacts.
+        """
+        if not self.keeps_files:
+            return None
+
+        destination = self.path(name)
+        if not self.owns(artifact):
+            fd, partial = tempfile.mkstemp(dir=self.directory, suffix=".part")
+            with os.fdopen(fd, "wb") as f:
+                if isinstance(artifact, (bytes, bytearray)):
+                    f.write(artifact)
+                elif hasattr(artifact, "read"):
+                    artifact.seek(0)
+                    shutil.copyfileobj(artifact, f)
+                    artifact.seek(0)
+                else:
+                    with open(artifact, "rb") as source:
+                        shutil.copyfileobj(source, f)
+            os.replace(partial, destination)
+        else:
+            destination = artifact
+
+        self.save(stage, {"path": destination})
+        return destination
+
+    def clear(self):
+        """
+            Forgets every stage and removes the artifacts, once the job has finished.
+        """
+        with self._lock:
+            self._stages = {}
+            if self._store is not None:
+                self._store.delete(self.job_id)
+        if self.keeps_files:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    @staticmethod
+    def purge(directory=CHECKPOINT_DIR, older_than=JOB_STORE_RETENTION, path=JOB_STORE_PATH):
+        """
+            Removes the stages and artifacts of jobs that were abandoned (never finished) long ago.
+        """
+        SqliteStore(path, table="checkpoints", ttl=older_than).purge_expired()
+        if not os.path.isdir(directory):
+            return
+        cutoff = time.time() - older_than
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
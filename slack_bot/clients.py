@@ -0,0 +1,103 @@
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+# The one place .env is read; every module that reads the environment at import imports this module first
+load_dotenv()
+
+__all__ = [
+    "openai_client",
+    "async_openai_client",
+    "slack_client",
+    "slack_http_session",
+    "dropbox_session"
+]
+
+SLACK_POOL_SIZE = int(os.getenv("SLACK_POOL_SIZE", 10))
+DROPBOX_POOL_SIZE = int(os.getenv("DROPBOX_POOL_SIZE", 10))
+SLACK_API_URL = os.getenv("SLACK_API_URL", "https://slack.com/api/") # Pointed at local stand-ins by bench_pipeline.py
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _shared(name, factory):
+    """
+        Returns the process-wide client called name, creating it with factory() on first use.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def _openai_client():
+    # openai takes most of a second to import, so it is only loaded when the first request needs it
+    from openai import OpenAI
+    # Retries are left to the shared rate limiter so 429s back off across every caller
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+
+def _async_openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+
+def _slack_client():
+    from slack_sdk import WebClient
+    return WebClient(token=os.getenv("SLACK_TOKEN"), timeout=180, base_url=SLACK_API_URL)
+
+
+def _slack_http_session():
+    session = requests.Session()
+    # No adapter retries, download_slack_file retries the whole transfer itself
+    adapter = HTTPAdapter(pool_maxsize=SLACK_POOL_SIZE)
+    # Plain http only occurs against local stand-ins, which should be reached the same way as Slack
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _dropbox_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=DROPBOX_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def openai_client():
+    """
+        The OpenAI client shared by prompt expansion and image generation.
+    """
+    return _shared("openai", _openai_client)
+
+
+def async_openai_client():
+    return _shared("async_openai", _async_openai_client)
+
+
+def slack_client():
+    """
+        The Slack WebClient shared by the dispatcher, the channel lookups and the archiver.
+    """
+    return _shared("slack", _slack_client)
+
+
+def slack_http_session():
+    """
+        Keep-alive connections shared by every Slack file download in the process.
+    """
+    return _shared("slack_http", _slack_http_session)
+
+
+def dropbox_session():
+    """
+        Keep-alive connections shared by every Dropbox call in the process.
+    """
+    return _shared("dropbox", _dropbox_session)
@@ -0,0 +1,68 @@
+import os
+from ttl_cache import TTLCache, SqliteStore
+
+__all__ = ["EventDeduplicator"]
+
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", 3600)) # Slack stops retrying well within an hour
+DEDUP_MAX_SIZE = int(os.getenv("DEDUP_MAX_SIZE", 10000))
+DEDUP_DB_PATH = os.getenv("DEDUP_DB_PATH") # Optional shared store for multiple processes
+
+
+class EventDeduplicator:
+    """
+        Remembers the Slack events that have already been accepted so that re-deliveries are ignored.
+        Events are identified by their event_id and, when present, the client_msg_id of the message.
+        The in-memory LRU is always consulted first; the optional SQLite store is shared between processes.
+    """
+    def __init__(self, ttl=DEDUP_TTL, max_size=DEDUP_MAX_SIZE, db_path=DEDUP_DB_PATH):
+        self.memory = TTLCache(max_size=max_size, ttl=ttl)
+        self.store = SqliteStore(db_path, table="seen_events", ttl=ttl) if db_path else None
+
+    @staticmethod
+    def keys_for(data):
+        """
+            Returns the identifying keys of an event_callback payload.
+        """
+        event = data.get("event", {})
+        keys = []
+        if data.get("event_id"):
+            keys.append(f"event:{data['event_id']}")
+        if event.get("client_msg_id"):
+            keys.append(f"msg:{event['client_msg_id']}")
+        return keys
+
+    def is_duplicate(self, data):
+        """
+            Records the event and returns True if any of its keys have been seen before.
+        """
+        keys = self.keys_for(data)
+        if not keys:
+            return False
+
+        if any(key in self.memory for key in keys):
+            return True
+
+        duplicate = False
+        for key in keys:
+            if self.store is not None:
+                try:
+                    if not self.store.add(key):
+                        duplicate = True
+                except Exception as e:
+                    print(f"Dedup store unavailable: {e}")
+            if not self.memory.add(key):
+                duplicate = True
+
+        return duplicate
+
+    def forget(self, data):
+        """
+            Removes the keys of an event that could not be accepted, so Slack's retry of it is handled.
+        """
+        for key in self.keys_for(data):
+            self.memory.delete(key)
+            if self.store is not None:
+                try:
+                    self.store.delete(key)
+                except Exception as e:
+                    print(f"Dedup store unavailable: {e}")
@@ -1,24 +1,38 @@
 import os
 import pathlib
-import pathlib
 import requests
 import json
 import base64
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
+import threading
+import time
+from clients import dropbox_session
+from metrics import RETRIES_TOTAL
 
 APP_KEY = os.getenv("DROPBOX_APP_KEY")
 APP_SECRET = os.getenv("DROPBOX_APP_SECRET")
 USER_ID = os.getenv("DROPBOX_USER_ID")
 DROPBOX_REFRESH_TOKEN = os.getenv("DROPBOX_REFRESH_TOKEN")
-DROPBOX_TOKEN_URL = "https://api.dropboxapi.com/oauth2/token"
+DROPBOX_API_URL = os.getenv("DROPBOX_API_URL", "https://api.dropboxapi.com")
+DROPBOX_CONTENT_URL = os.getenv("DROPBOX_CONTENT_URL", "https://content.dropboxapi.com")
+DROPBOX_TOKEN_URL = DROPBOX_API_URL + "/oauth2/token"
+DROPBOX_TOKEN_REFRESH_MARGIN = int(os.getenv("DROPBOX_TOKEN_REFRESH_MARGIN", 300)) # Seconds before expiry to refresh
+DROPBOX_CHUNK_SIZE = int(os.getenv("DROPBOX_CHUNK_SIZE", 8 * 1024 * 1024)) # Upload session chunk size in bytes
+DROPBOX_UPLOAD_RETRIES = int(os.getenv("DROPBOX_UPLOAD_RETRIES", 3))
+DROPBOX_BATCH_SIZE = int(os.getenv("DROPBOX_BATCH_SIZE", 100)) # Files committed per finish_batch call, at most 1000
+DROPBOX_BATCH_POLL_INTERVAL = float(os.getenv("DROPBOX_BATCH_POLL_INTERVAL", 1))
+DROPBOX_BATCH_TIMEOUT = float(os.getenv("DROPBOX_BATCH_TIMEOUT", 300))
+
 
 def get_access_token(app_key, app_secret, refresh_token):
     """
     Uses the refresh token to get a new short-lived access token.
     """
+    return _request_access_token(app_key, app_secret, refresh_token)[0]
+
+def _request_access_token(app_key, app_secret, refresh_token):
+    """
+    Exchanges the refresh token for an access token and returns it with its lifetime in seconds.
+    """
     basic_auth = base64.b64encode(f"{app_key}:{app_secret}".encode()).decode()
 
     headers = {
@@ -31,66 +45,475 @@ def get_access_token(app_key, app_secret, refresh_token):
         "refresh_token": refresh_token
     }
 
-    response = requests.post(DROPBOX_TOKEN_URL, headers=headers, data=data)
+    response = dropbox_session().post(DROPBOX_TOKEN_URL, headers=headers, data=data)
     response.raise_for_status()
 
-    return response.json()["access_token"]
+    body = response.json()
+    return body["access_token"], int(body.get("expires_in", 14400))
 
-def upload_to_shared_folder(file_path: str, folder_id):
+class DropboxTokenCache:
     """
-        Uploads a given file path to a shared dropbox folder. 
-        The function must be supplied a known file ID and user id to perform this request. 
+    Thread-safe cache of the short-lived Dropbox access token.
+    The token is refreshed refresh_margin seconds before it expires.
+    Only one refresh runs at a time; other callers wait for it and reuse its result.
+    """
+    def __init__(self, app_key, app_secret, refresh_token, refresh_margin=DROPBOX_TOKEN_REFRESH_MARGIN):
+        self.app_key = app_key
+        self.app_secret = app_secret
+        self.refresh_token = refresh_token
+        self.refresh_margin = refresh_margin
+
+        self._token = None
+        self._expires_at = 0
+        self._generation = 0 # Incremented on every successful refresh
+        self._refreshing = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    def get(self, force_refresh=False):
+        """
+        Returns a valid access token, refreshing it if it is missing, about to expire or force_refresh is set.
+        """
+        with self._cond:
+            if not force_refresh and self._token and time.time() < self._expires_at - self.refresh_margin:
+                return self._token
+
+            generation = self._generation
+            if self._refreshing:
+                # Another caller is already refreshing, wait for its result
+                while self._refreshing:
+                    self._cond.wait()
+                if self._generation != generation and self._token:
+                    return self._token
+                raise RuntimeError(f"Dropbox token refresh failed: {self._error}")
+
+            self._refreshing = True
+
+        try:
+            token, expires_in = _request_access_token(self.app_key, self.app_secret, self.refresh_token)
+        except Exception as e:
+            with self._cond:
+                self._error = e
+                self._refreshing = False
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self._token = token
+            self._expires_at = time.time() + expires_in
+            self._generation += 1
+            self._error = None
+            self._refreshing = False
+            self._cond.notify_all()
+            return token
+
+    def invalidate(self, token):
+        """
+        Drops the cached token if it is still the given (rejected) token.
+        """
+        with self._cond:
+            if self._token == token:
+                self._token = None
+                self._expires_at = 0
+
+token_cache = DropboxTokenCache(APP_KEY, APP_SECRET, DROPBOX_REFRESH_TOKEN)
+
+def _post_with_token(url, headers, **kwargs):
+    """
+    Posts to the Dropbox API with the cached access token.
+    A 401 means the token was revoked or expired early, so it is refreshed once and the request retried.
     """
-    # Convert file path to a Path object
-    file = pathlib.Path(file_path)
-    
-    if not file.exists():
-        return {"error": "File does not exist"}
-    
-    # Exchange refresh token for short-lived access token
     try:
-        access_token = get_access_token(APP_KEY, APP_SECRET, DROPBOX_REFRESH_TOKEN)
+        access_token = token_cache.get()
     except Exception as e:
-        return {"error": "Failed to get access token", "details": str(e)}
-    
-    # Read the file content
-    file_content = file.read_bytes()
-    file_name = file.name
+        raise requests.RequestException(f"Failed to get access token: {e}")
 
-    # Specify the Dropbox path using the shared folder ID
-    dropbox_path = f"/{file_name}"  # The file will appear in the root of the shared folder
+    response = dropbox_session().post(url, headers={**headers, "Authorization": f"Bearer {access_token}"}, **kwargs)
+    if response.status_code != 401:
+        return response
 
-    url = "https://content.dropboxapi.com/2/files/upload"
+    token_cache.invalidate(access_token)
+    try:
+        access_token = token_cache.get()
+    except Exception as e:
+        raise requests.RequestException(f"Failed to get access token: {e}")
 
-    # Set the request headers
-    headers = {
-        "Authorization": f"Bearer {access_token}",
+    return dropbox_session().post(url, headers={**headers, "Authorization": f"Bearer {access_token}"}, **kwargs)
+
+def _content_headers(folder_id, api_arg):
+    """
+    Headers for a call to the Dropbox content endpoints inside the shared folder's namespace.
+    """
+    return {
         "Dropbox-API-Select-User": USER_ID,
         "Dropbox-API-Path-Root": json.dumps({
             ".tag": "namespace_id",
             "namespace_id": folder_id
         }),
         "Content-Type": "application/octet-stream",
-        "Dropbox-API-Arg": json.dumps({
-            "path": dropbox_path,
-            "mode": "add",
-            "autorename": True,
-            "mute": False
-        })
+        "Dropbox-API-Arg": json.dumps(api_arg)
+    }
+
+def _api_headers(folder_id):
+    """
+    Headers for a call to the Dropbox RPC endpoints inside the shared folder's namespace.
+    """
+    return {
+        "Dropbox-API-Select-User": USER_ID,
+        "Dropbox-API-Path-Root": json.dumps({
+            ".tag": "namespace_id",
+            "namespace_id": folder_id
+        }),
+        "Content-Type": "application/json"
     }
 
-    # print("Uploading to Dropbox Shared Folder...")
-    # print(f"User ID: {USER_ID}")
-    # print(f"Shared Folder ID: {folder_id}")
-    # print(f"Dropbox Path: {dropbox_path}")
+def _commit_info(dropbox_path):
+    return {
+        "path": dropbox_path,
+        "mode": "add",
+        "autorename": True,
+        "mute": False
+    }
 
+def _open_source(source, file_name=None):
+    """
+    Accepts a file path or a seekable binary buffer.
+    Returns the open stream, its name, its size and whether the caller must close it.
+    """
+    if hasattr(source, "read"):
+        if not file_name:
+            raise ValueError("file_name is required when uploading from a buffer")
+        stream = source
+        owned = False
+    else:
+        file = pathlib.Path(source)
+        if not file.exists():
+            raise FileNotFoundError(str(file))
+        stream = open(file, "rb")
+        file_name = file_name or file.name
+        owned = True
+
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return stream, file_name, size, owned
+
+def _correct_offset(response):
+    """
+    Returns the offset Dropbox reports it has received when an append was rejected for a wrong offset.
+    """
     try:
-        response = requests.post(url, headers=headers, data=file_content)
+        error = response.json().get("error", {})
+    except ValueError:
+        return None
+
+    # The offset error is nested one level deeper for some endpoints
+    for candidate in (error, error.get("lookup_failed", {})):
+        if isinstance(candidate, dict) and candidate.get(".tag") == "incorrect_offset":
+            return candidate.get("correct_offset")
+    return None
+
+def _is_transient(error):
+    """
+    Whether a failed Dropbox request is worth retrying: rate limits, server errors and network failures.
+    Other 4xx responses fail the same way on every attempt.
+    """
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and (response.status_code == 429 or response.status_code >= 500)
+
+def _retry_delay(error, attempt):
+    response = getattr(error, "response", None)
+    if response is not None and response.status_code == 429 and "Retry-After" in response.headers:
+        return float(response.headers["Retry-After"])
+    return 2 ** attempt
+
+def _start_session(stream, offset, chunk_size, folder_id, close=False):
+    """
+    Opens an upload session with the first chunk of the stream and returns the session id.
+    """
+    stream.seek(offset)
+    chunk = stream.read(chunk_size)
+    last_error = None
+
+    for attempt in range(DROPBOX_UPLOAD_RETRIES + 1):
+        try:
+            response = _post_with_token(
+                DROPBOX_CONTENT_URL + "/2/files/upload_session/start",
+                _content_headers(folder_id, {"close": close}),
+                data=chunk
+            )
+            response.raise_for_status()
+            return response.json()["session_id"], offset + len(chunk)
+        except requests.RequestException as e:
+            last_error = e
+            if not _is_transient(e):
+                raise
+            if attempt < DROPBOX_UPLOAD_RETRIES:
+                RETRIES_TOTAL.inc(service="dropbox")
+                time.sleep(_retry_delay(e, attempt))
+
+    raise last_error
+
+def _append_chunks(stream, session_id, offset, size, chunk_size, folder_id, close=False):
+    """
+    Appends the rest of the stream to an upload session, one chunk at a time.
+    On failure the upload resumes from the last offset Dropbox acknowledged.
+    Returns the final offset.
+    """
+    failures = 0
+    while offset < size:
+        stream.seek(offset)
+        chunk = stream.read(chunk_size)
+        is_last = offset + len(chunk) >= size
+
+        try:
+            response = _post_with_token(
+                DROPBOX_CONTENT_URL + "/2/files/upload_session/append_v2",
+                _content_headers(folder_id, {
+                    "cursor": {"session_id": session_id, "offset": offset},
+                    "close": close and is_last
+                }),
+                data=chunk
+            )
+        except requests.RequestException as e:
+            failures += 1
+            if not _is_transient(e) or failures > DROPBOX_UPLOAD_RETRIES:
+                raise
+            print(f"Dropbox append failed at offset {offset}, retrying: {e}")
+            RETRIES_TOTAL.inc(service="dropbox")
+            time.sleep(2 ** failures)
+            continue
+
+        if response.status_code == 409:
+            correct_offset = _correct_offset(response)
+            if correct_offset is not None:
+                # Dropbox already has more (or less) than we thought, continue from its offset.
+                # A session that keeps reporting offsets without accepting a chunk must not loop forever
+                failures += 1
+                if failures > DROPBOX_UPLOAD_RETRIES:
+                    response.raise_for_status()
+                print(f"Dropbox expected offset {correct_offset} instead of {offset}, resyncing")
+                offset = correct_offset
+                continue
+
+        if response.status_code >= 500 or response.status_code == 429:
+            failures += 1
+            if failures > DROPBOX_UPLOAD_RETRIES:
+                response.raise_for_status()
+            RETRIES_TOTAL.inc(service="dropbox")
+            time.sleep(float(response.headers.get("Retry-After", 2 ** failures)))
+            continue
+
+        response.raise_for_status()
+        offset += len(chunk)
+        failures = 0
+
+    return offset
+
+def upload_session_to_shared_folder(source, folder_id, file_name=None, chunk_size=None):
+    """
+        Streams a file path or binary buffer to a shared dropbox folder through an upload session.
+        The file is sent chunk_size bytes at a time so it is never held in memory as a whole,
+        and a failed chunk is resumed from the last acknowledged offset instead of from zero.
+    """
+    chunk_size = chunk_size or DROPBOX_CHUNK_SIZE
+
+    try:
+        stream, file_name, size, owned = _open_source(source, file_name)
+    except FileNotFoundError:
+        return {"error": "File does not exist"}
+
+    dropbox_path = f"/{file_name}"
+
+    try:
+        session_id, offset = _start_session(stream, 0, chunk_size, folder_id)
+        offset = _append_chunks(stream, session_id, offset, size, chunk_size, folder_id)
+
+        for attempt in range(DROPBOX_UPLOAD_RETRIES + 1):
+            try:
+                response = _post_with_token(
+                    DROPBOX_CONTENT_URL + "/2/files/upload_session/finish",
+                    _content_headers(folder_id, {
+                        "cursor": {"session_id": session_id, "offset": offset},
+                        "commit": _commit_info(dropbox_path)
+                    }),
+                    data=b""
+                )
+                response.raise_for_status()
+                break
+            except requests.RequestException as e:
+                if not _is_transient(e) or attempt == DROPBOX_UPLOAD_RETRIES:
+                    raise
+                RETRIES_TOTAL.inc(service="dropbox")
+                time.sleep(_retry_delay(e, attempt))
+
         print(f"Response Status: {response.status_code}")
-        # print(f"Response Text: {response.text}")
-        response.raise_for_status()  # This will raise an error for non-200 responses
         return {"message": "File uploaded successfully", "dropbox_path": dropbox_path}
 
     except requests.RequestException as e:
         print(f"Error Details: {str(e)}")
-        return {"error": "Failed to upload file to Dropbox", "details": str(e)}
\ No newline at end of file
+        return {"error": "Failed to upload file to Dropbox", "details": str(e)}
+
+    finally:
+        if owned:
+            stream.close()
+
+def upload_to_shared_folder(file_path, folder_id, file_name=None):
+    """
+        Uploads a given file path or binary buffer to a shared dropbox folder. 
+        The function must be supplied a known file ID and user id to perform this request. 
+        Files larger than one chunk are streamed through an upload session.
+        Rate limits, server errors and network failures are retried up to DROPBOX_UPLOAD_RETRIES times.
+    """
+    try:
+        stream, file_name, size, owned = _open_source(file_path, file_name)
+    except FileNotFoundError:
+        return {"error": "File does not exist"}
+
+    if size > DROPBOX_CHUNK_SIZE:
+        if owned:
+            stream.close()
+        return upload_session_to_shared_folder(file_path, folder_id, file_name)
+
+    # Specify the Dropbox path using the shared folder ID
+    dropbox_path = f"/{file_name}"  # The file will appear in the root of the shared folder
+
+    url = DROPBOX_CONTENT_URL + "/2/files/upload"
+
+    # Set the request headers
+    headers = _content_headers(folder_id, _commit_info(dropbox_path))
+
+    try:
+        file_content = stream.read()
+        # Retry rate limits, server errors and dropped connections like the upload session does
+        for attempt in range(DROPBOX_UPLOAD_RETRIES + 1):
+            try:
+                response = _post_with_token(url, headers, data=file_content)
+                print(f"Response Status: {response.status_code}")
+                # print(f"Response Text: {response.text}")
+                response.raise_for_status()  # This will raise an error for non-200 responses
+                break
+            except requests.RequestException as e:
+                if not _is_transient(e) or attempt == DROPBOX_UPLOAD_RETRIES:
+                    raise
+                RETRIES_TOTAL.inc(service="dropbox")
+                time.sleep(_retry_delay(e, attempt))
+        return {"message": "File uploaded successfully", "dropbox_path": dropbox_path}
+
+    except requests.RequestException as e:
+        print(f"Error Details: {str(e)}")
+        return {"error": "Failed to upload file to Dropbox", "details": str(e)}
+
+    finally:
+        if owned:
+            stream.close()
+
+def _upload_closed_session(source, folder_id, file_name=None, chunk_size=None):
+    """
+    Uploads the whole file into a closed upload session without committing it.
+    Returns the finish_batch entry for the file.
+    """
+    chunk_size = chunk_size or DROPBOX_CHUNK_SIZE
+    stream, file_name, size, owned = _open_source(source, file_name)
+
+    try:
+        session_id, offset = _start_session(stream, 0, chunk_size, folder_id, close=size <= chunk_size)
+        offset = _append_chunks(stream, session_id, offset, size, chunk_size, folder_id, close=True)
+    finally:
+        if owned:
+            stream.close()
+
+    return {
+        "cursor": {"session_id": session_id, "offset": offset},
+        "commit": _commit_info(f"/{file_name}")
+    }
+
+def _finish_batch(entries, folder_id):
+    """
+    Commits a group of closed upload sessions and waits for the async job to complete.
+    Returns the list of per-entry results reported by Dropbox, in the same order as entries.
+    """
+    response = _post_with_token(
+        DROPBOX_API_URL + "/2/files/upload_session/finish_batch",
+        _api_headers(folder_id),
+        json={"entries": entries}
+    )
+    response.raise_for_status()
+    body = response.json()
+
+    job_id = body.get("async_job_id")
+    deadline = time.time() + DROPBOX_BATCH_TIMEOUT
+    while body.get(".tag") in ("async_job_id", "in_progress"):
+        if time.time() > deadline:
+            raise requests.RequestException("Timed out waiting for Dropbox batch commit")
+
+        time.sleep(DROPBOX_BATCH_POLL_INTERVAL)
+        response = _post_with_token(
+            DROPBOX_API_URL + "/2/files/upload_session/finish_batch/check",
+            _api_headers(folder_id),
+            json={"async_job_id": job_id}
+        )
+        response.raise_for_status()
+        body = response.json()
+
+    if body.get(".tag") != "complete":
+        raise requests.RequestException(f"Dropbox batch commit failed: {body}")
+
+    return body["entries"]
+
+def upload_batch_to_shared_folder(files, folder_id, batch_size=None):
+    """
+        Uploads many files to a shared dropbox folder, committing them in groups of batch_size.
+        Each item of files is a file path or a (buffer, file_name) tuple.
+        Returns one result per file, in order, in the same shape as upload_to_shared_folder,
+        so a failed file does not fail the rest of the batch.
+    """
+    batch_size = min(batch_size or DROPBOX_BATCH_SIZE, 1000)
+    results = [None] * len(files)
+
+    for start in range(0, len(files), batch_size):
+        entries = []
+        indexes = []
+
+        for i in range(start, min(start + batch_size, len(files))):
+            item = files[i]
+            source, file_name = item if isinstance(item, tuple) else (item, None)
+            try:
+                entries.append(_upload_closed_session(source, folder_id, file_name))
+                indexes.append(i)
+            except FileNotFoundError:
+                results[i] = {"error": "File does not exist"}
+            except (requests.RequestException, ValueError) as e:
+                print(f"Error Details: {str(e)}")
+                results[i] = {"error": "Failed to upload file to Dropbox", "details": str(e)}
+
+        if not entries:
+            continue
+
+        try:
+            outcomes = _finish_batch(entries, folder_id)
+        except requests.RequestException as e:
+            print(f"Error Details: {str(e)}")
+            for i in indexes:
+                results[i] = {"error": "Failed to commit file to Dropbox", "details": str(e)}
+            continue
+
+        for i, entry, outcome in zip(indexes, entries, outcomes):
+            if outcome.get(".tag") == "success":
+                results[i] = {
+                    "message": "File uploaded successfully",
+                    "dropbox_path": outcome.get("path_display", entry["commit"]["path"])
+                }
+            else:
+                results[i] = {"error": "Failed to commit file to Dropbox", "details": json.dumps(outcome.get("failure", outcome))}
+
+        # A short answer from Dropbox must not leave a file without a result
+        for i in indexes[len(outcomes):]:
+            results[i] = {
+                "error": "Failed to commit file to Dropbox",
+                "details": f"Dropbox returned {len(outcomes)} results for {len(entries)} files"
+            }
+
+    return results
@@ -0,0 +1,271 @@
+import base64
+import io
+import json
+import multiprocessing
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import requests
+from PIL import Image
+
+__all__ = ["FakeServices", "SERVICES", "sample_png"]
+
+# Mean latency in seconds of each stand-in, overridable per run
+SERVICES = {
+    "slack": 0.05, # Web API methods
+    "slack_files": 0.1, # url_private downloads and files_upload_v2 uploads
+    "openai_images": 2.0, # images.generate and images.edit
+    "openai_responses": 0.5, # Prompt expansion
+    "dropbox": 0.2, # OAuth, content and RPC endpoints
+}
+LATENCY_JITTER = 0.25 # Each latency is drawn uniformly within this fraction of the mean
+
+
+def sample_png(size=(1024, 1024)):
+    """
+    A PNG that compresses like a real generation: smooth colour regions rather than flat colour or pure noise,
+    so resizing and encoding it costs what a real output does.
+    """
+    bands = [Image.effect_noise((size[0] // 16, size[1] // 16), 80).resize(size, Image.BICUBIC) for _ in range(3)]
+    alpha = Image.new("L", size, 255)
+    buffer = io.BytesIO()
+    Image.merge("RGBA", (*bands, alpha)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+        Routes every request of one stand-in to a method named after the service, after sleeping for its latency.
+        A share of requests, set by the service's error rate, fail with a 429 (with Retry-After) or a 503 instead.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _params(self, body):
+        """
+            The arguments of a Web API call, sent as JSON or form encoded depending on the method.
+        """
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def _reply(self, status, body=b"", content_type="application/json", headers=None):
+        if not isinstance(body, (bytes, bytearray)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        state = self.server.state
+        path = urlparse(self.path).path
+        body = self._body()
+
+        if path == "/__stats":
+            with state["lock"]:
+                return self._reply(200, dict(state["stats"]))
+
+        service = self.server.route(path)
+        latency = state["latency"][service]
+        time.sleep(max(0.0, latency * random.uniform(1 - LATENCY_JITTER, 1 + LATENCY_JITTER)))
+
+        with state["lock"]:
+            state["stats"][f"{service}_requests"] = state["stats"].get(f"{service}_requests", 0) + 1
+            failed = random.random() < state["errors"][service]
+            if failed:
+                state["stats"][f"{service}_errors"] = state["stats"].get(f"{service}_errors", 0) + 1
+
+        if failed:
+            if random.random() < 0.5:
+                error = {"ok": False, "error": "ratelimited"} if service == "slack" else {"error": {"message": "Rate limited"}}
+                return self._reply(429, error, headers={"Retry-After": "1"})
+            return self._reply(503, {"ok": False, "error": "service_unavailable"})
+
+        return getattr(self, service)(path, body)
+
+    # Slack Web API: https://slack.com/api/<method>
+    def slack(self, path, body):
+        method = path.rsplit("/", 1)[-1]
+        ts = f"{time.time():.6f}"
+        if method in ("chat.postMessage", "chat.update"):
+            return self._reply(200, {"ok": True, "ts": ts, "channel": "C"})
+        if method == "files.getUploadURLExternal":
+            file_id = "F" + uuid.uuid4().hex[:10].upper()
+            return self._reply(200, {"ok": True, "file_id": file_id, "upload_url": f"{self.server.files_url}/upload/{file_id}"})
+        if method == "files.completeUploadExternal":
+            files = self._params(body).get("files") or [{"id": "F0"}]
+            if isinstance(files, str):
+                files = json.loads(files)
+            return self._reply(200, {"ok": True, "files": [{"id": f.get("id"), "title": f.get("title")} for f in files]})
+        if method == "conversations.history":
+            return self._reply(200, {"ok": True, "messages": self.server.history, "has_more": False})
+        return self._reply(200, {"ok": True})
+
+    # Slack file downloads and the upload step of files_upload_v2
+    def slack_files(self, path, body):
+        if path.startswith("/upload/"):
+            return self._reply(200, f"OK - {len(body)}".encode(), "text/plain")
+        return self._reply(200, self.server.image, "image/png")
+
+    # OpenAI: /v1/images/generations, /v1/images/edits
+    def openai_images(self, path, body):
+        return self._reply(200, {"created": int(time.time()), "data": [{"b64_json": self.server.image_b64}]})
+
+    # OpenAI: /v1/responses
+    def openai_responses(self, path, body):
+        text = "A detailed illustration for a print, centred on a transparent background, " + uuid.uuid4().hex
+        return self._reply(200, {
+            "id": "resp_" + uuid.uuid4().hex,
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": "gpt-4o",
+            "status": "completed",
+            "output": [{
+                "type": "message",
+                "id": "msg_" + uuid.uuid4().hex,
+                "role": "assistant",
+                "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}]
+            }]
+        })
+
+    # Dropbox: oauth2/token, files/upload, upload_session/* and finish_batch/check
+    def dropbox(self, path, body):
+        if path == "/oauth2/token":
+            return self._reply(200, {"access_token": "bench-" + uuid.uuid4().hex, "expires_in": 14400})
+        if path == "/2/files/upload_session/start":
+            return self._reply(200, {"session_id": uuid.uuid4().hex})
+        if path == "/2/files/upload_session/append_v2":
+            return self._reply(200, b"null")
+        if path == "/2/files/upload_session/finish_batch":
+            # Like Dropbox, the commit runs as an async job that has to be polled
+            job_id = uuid.uuid4().hex
+            entries = json.loads(body or b"{}").get("entries", [])
+            with self.server.state["lock"]:
+                self.server.batches[job_id] = [entry["commit"]["path"] for entry in entries]
+            return self._reply(200, {".tag": "async_job_id", "async_job_id": job_id})
+        if path == "/2/files/upload_session/finish_batch/check":
+            with self.server.state["lock"]:
+                paths = self.server.batches.pop(json.loads(body)["async_job_id"], [])
+            return self._reply(200, {".tag": "complete", "entries": [{".tag": "success", "path_display": p} for p in paths]})
+
+        arg = json.loads(self.headers.get("Dropbox-API-Arg") or "{}")
+        dropbox_path = arg.get("path") or arg.get("commit", {}).get("path", "/file")
+        return self._reply(200, {"name": dropbox_path.rsplit("/", 1)[-1], "path_display": dropbox_path, "size": len(body)})
+
+
+def _routes(path):
+    if path.startswith("/api/"):
+        return "slack"
+    if path.startswith("/v1/images"):
+        return "openai_images"
+    if path.startswith("/v1/responses"):
+        return "openai_responses"
+    if path.startswith("/oauth2/") or path.startswith("/2/"):
+        return "dropbox"
+    return "slack_files"
+
+
+def _serve(latency, errors, archive_files, bot_user, ready):
+    image = sample_png()
+    state = {"latency": latency, "errors": errors, "stats": {}, "lock": threading.Lock()}
+
+    # One server per stand-in so each keeps its own connections and thread pool
+    servers = {}
+    for name in ("slack", "slack_files", "openai", "dropbox"):
+        server = _Server(("127.0.0.1", 0), _Handler)
+        server.state = state
+        server.route = _routes
+        server.image = image
+        server.image_b64 = base64.b64encode(image).decode()
+        server.batches = {}
+        servers[name] = server
+
+    files_url = f"http://127.0.0.1:{servers['slack_files'].server_address[1]}"
+    history = [{
+        "ts": f"{time.time() - i:.6f}",
+        "files": [{
+            "id": f"FARCHIVE{i}",
+            "name": f"archived_{i}.png",
+            "size": len(image),
+            "url_private": f"{files_url}/files/FARCHIVE{i}/archived_{i}.png",
+            "user": bot_user,
+            "timestamp": int(time.time()) - i
+        }]
+    } for i in range(archive_files)]
+    for server in servers.values():
+        server.files_url = files_url
+        server.history = history
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    urls = {name: f"http://127.0.0.1:{server.server_address[1]}" for name, server in servers.items()}
+    ready.send((urls, len(image)))
+    threading.Event().wait()
+
+
+class FakeServices:
+    """
+        Local stand-ins for the Slack Web API and file downloads, OpenAI images and responses, and Dropbox
+        content and OAuth, run in a child process so they do not count towards the bot's CPU or memory.
+        latency and errors map service names (see SERVICES) to a mean latency in seconds and an error rate.
+        urls holds the base url of each server once started, image_size the size of the PNG they serve.
+    """
+    def __init__(self, latency=None, errors=None, archive_files=50, bot_user="UBENCHBOT"):
+        self.latency = {**SERVICES, **(latency or {})}
+        self.errors = {name: 0.0 for name in SERVICES} | (errors or {})
+        self.archive_files = archive_files
+        self.bot_user = bot_user
+        self.urls = None
+        self.image_size = None
+        self._process = None
+
+    def start(self):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self._process = multiprocessing.get_context("spawn").Process(
+            target=_serve, args=(self.latency, self.errors, self.archive_files, self.bot_user, sender), daemon=True
+        )
+        self._process.start()
+        self.urls, self.image_size = receiver.recv()
+        return self.urls
+
+    def stats(self):
+        """
+            Returns the request and injected error counts of every service.
+        """
+        return requests.get(self.urls["slack"] + "/__stats", timeout=5).json()
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
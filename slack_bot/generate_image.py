@@ -1,77 +1,117 @@
 import requests 
 import os
 import base64
-from dotenv import load_dotenv
-from openai import OpenAI
+from clients import openai_client, async_openai_client
+from rate_limiter import openai_limiter
 
-load_dotenv()
+__all__ = ["generate_image", "edit_image", "generate_image_async", "edit_image_async"]
 
-__all__ = ["generate_image", "edit_image"]
-
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 model = "gpt-image-1"  # "dall-e-2 "
+size = "1024x1024"
 
-def edit_image(logger, prompt, input_filename):
-    try:
-        if os.path.exists(input_filename):
-            print(f"File is valid and can be used for image generation.")
-        
-        else:
-            print(f"File is invalid and cannot be used for image generation.")
+IMAGE_MIME_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp"
+}
+
+def _image_upload(input_image, filename=None):
+    """
+    Returns the image argument for images.edit from a file path or the bytes of an image.
+    """
+    if isinstance(input_image, (bytes, bytearray)):
+        filename = filename or "input.png"
+        ext = filename.rsplit(".", 1)[-1].lower()
+        return (filename, bytes(input_image), IMAGE_MIME_TYPES.get(ext, "image/png"))
+
+    with open(input_image, "rb") as f:
+        return (os.path.basename(input_image), f.read(), IMAGE_MIME_TYPES.get(input_image.rsplit(".", 1)[-1].lower(), "image/png"))
+
+def _image_request(prompt, input_image=None, filename=None):
+    """
+    Returns the images method ("generate" or "edit") and its arguments for the configured model.
+    """
+    if model == "dall-e-2":
+        return "generate", dict(
+            model=model,
+            prompt=prompt[:1000],
+            size=size,
+            n=1,
+            response_format="b64_json", # Comment this line when using gpt-image-1 model
+        )
+
+    if input_image is None:
+        return "generate", dict(
+            model=model,
+            prompt=prompt[:1000], # Input prompt is restricted to 100 characters
+            size=size,
+            n=1,
+        )
+
+    return "edit", dict(
+        model=model,
+        prompt=prompt[:1000], # Input prompt is restricted to 100 characters
+        image=_image_upload(input_image, filename),
+        size=size,
+        n=1,
+    )
 
-        if model == "dall-e-2":
-            response = client.images.generate(
-                model=model,
-                prompt=prompt[:1000],
-                size="1024x1024",
-                n=1,
-                response_format="b64_json", # Comment this line when using gpt-image-1 model
-            )
-        
-        elif model == "gpt-image-1":
-            response = client.images.edit(
-                model=model,
-                prompt=prompt[:1000], # Input prompt is restricted to 100 characters
-                image=(
-                    open(input_filename, 'rb')
-                ),
-                size="1024x1024",
-                n=1,
-            )
+def _check_input(input_image):
+    if isinstance(input_image, (bytes, bytearray)) or os.path.exists(input_image):
+        print(f"File is valid and can be used for image generation.")
+    else:
+        print(f"File is invalid and cannot be used for image generation.")
 
-        image_base64 = response.data[0].b64_json
-        image_bytes = base64.b64decode(image_base64)
+def _decode(response):
+    image_base64 = response.data[0].b64_json
+    return base64.b64decode(image_base64)
 
-        return image_bytes
+def _failure(logger, e):
+    print(f"Error during image generation: {e}")
+    logger.info(f"Error during image generation: {e}")
+    return {"error": str(e), "exception": e}
+
+def edit_image(logger, prompt, input_image, filename=None):
+    """
+    Edits the input image, given as a file path or as bytes, with the prompt.
+    filename names the image when it is passed as bytes.
+    """
+    try:
+        _check_input(input_image)
+        method, arguments = _image_request(prompt, input_image, filename)
+        response = openai_limiter.call(model, lambda: getattr(openai_client().images, method)(**arguments), images=1)
+        return _decode(response)
     except Exception as e:
-        print(f"Error during image generation: {e}")
-        logger.info(f"Error during image generation: {e}")
-        return {"error": str(e), "exception": e}
+        return _failure(logger, e)
 
 def generate_image(logger, prompt):
     try:
-        if model == "dall-e-2":
-            response = client.images.generate(
-                model=model,
-                prompt=prompt[:1000],
-                size="1024x1024",
-                n=1,
-                response_format="b64_json", # Comment this line when using gpt-image-1 model
-            )
-        
-        elif model == "gpt-image-1":
-            response = client.images.generate(
-                model=model,
-                prompt=prompt[:1000], # Input prompt is restricted to 100 characters
-                size="1024x1024",
-                n=1,
-            )
+        method, arguments = _image_request(prompt)
+        response = openai_limiter.call(model, lambda: getattr(openai_client().images, method)(**arguments), images=1)
+        return _decode(response)
+    except Exception as e:
+        return _failure(logger, e)
 
-        image_base64 = response.data[0].b64_json
-        image_bytes = base64.b64decode(image_base64)
+async def edit_image_async(logger, prompt, input_image, filename=None):
+    """
+    The asyncio version of edit_image, used by the asyncio execution engine.
+    """
+    try:
+        _check_input(input_image)
+        method, arguments = _image_request(prompt, input_image, filename)
+        response = await openai_limiter.call_async(model, lambda: getattr(async_openai_client().images, method)(**arguments), images=1)
+        return _decode(response)
+    except Exception as e:
+        return _failure(logger, e)
 
-        return image_bytes
+async def generate_image_async(logger, prompt):
+    """
+    The asyncio version of generate_image, used by the asyncio execution engine.
+    """
+    try:
+        method, arguments = _image_request(prompt)
+        response = await openai_limiter.call_async(model, lambda: getattr(async_openai_client().images, method)(**arguments), images=1)
+        return _decode(response)
     except Exception as e:
-        print(f"Error during image generation: {e}")
-        logger.info(f"Error during image generation: {e}")
-        return {"error": str(e), "exception": e}
\ No newline at end of file
+        return _failure(logger, e)
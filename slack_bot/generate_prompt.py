@@ -1,30 +1,24 @@
 import base64
+import hashlib
+import json
 import os
 import io
 from PIL import Image
-from dotenv import load_dotenv
-from openai import OpenAI
+from clients import openai_client, async_openai_client
+from ttl_cache import TTLCache, SqliteStore
+from rate_limiter import openai_limiter
+from metrics import PROMPT_CACHE_TOTAL
 
 
-__all__ = ["generate_prompt"]
+__all__ = ["generate_prompt", "generate_prompt_async"]
 
-load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+PROMPT_MODEL = "gpt-4o"
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", 512))
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", 7 * 24 * 3600))
+PROMPT_CACHE_PATH = os.getenv("PROMPT_CACHE_PATH") # Optional SQLite file so expansions survive restarts
 
-# Function to encode the image
-def encode_image(image_path):
-    with Image.open(image_path) as image_file:
-        buffered = io.BytesIO()
-        resized_img = image_file.resize((150, 150))
-        resized_img.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode("utf-8")
-
-def generate_prompt(mode="image-edit", injection=""):
-    # Getting the Base64 string
-    # base64_image = encode_image(image_path)
-    
-    dense_prompt = """
+IMAGE_EDIT_PROMPT = """
     Recreate the central design of this image.
     The design must be by itself without any of the background context. 
     The design should be immediately transferrable as printable for a T-Shirt.
@@ -34,30 +28,110 @@ def generate_prompt(mode="image-edit", injection=""):
     Ensure the design is centered on the canvas with at least 15% transparent margin so nothing is cropped.
     Transparent background is very important. Zoom out so the entire graphic is visible.
     """
-    if mode == "image-edit": return dense_prompt
 
-    if mode == "prompt-only":
-        dense_prompt = """
+PROMPT_ONLY_TEMPLATE = """
         Add details to this prompt so that it can be used as a prompt for a graphic design. 
         The design should be immediately transferrable as printable for a T-Shirt.
         I want just the central design described with a transparent background.
         Ensure the design is centered on the canvas with at least 15% transparent margin so nothing is cropped.
         Transparent background is very important. Zoom-out so the entire graphic is visible.
         """
+
+# Expanded prompts keyed on the normalized injection, the template and the model
+_memory_cache = TTLCache(max_size=PROMPT_CACHE_SIZE, ttl=PROMPT_CACHE_TTL)
+_disk_cache = SqliteStore(PROMPT_CACHE_PATH, table="prompt_cache", ttl=PROMPT_CACHE_TTL) if PROMPT_CACHE_PATH else None
+if _disk_cache is not None:
+    _disk_cache.purge_expired()
+
+# Function to encode the image
+def encode_image(image_path):
+    with Image.open(image_path) as image_file:
+        buffered = io.BytesIO()
+        resized_img = image_file.resize((150, 150))
+        resized_img.save(buffered, format="PNG")
+        return base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+def _normalize_injection(injection):
+    # Spacing differences do not change the expanded prompt; case does, since the text is printed as written
+    return " ".join((injection or "").split())
+
+def _cache_key(injection):
+    template_hash = hashlib.sha256(PROMPT_ONLY_TEMPLATE.encode()).hexdigest()[:16]
+    raw = json.dumps([_normalize_injection(injection), template_hash, PROMPT_MODEL])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _cached_expansion(key):
+    cached = _memory_cache.get(key)
+    if cached is None and _disk_cache is not None:
+        cached = _disk_cache.get(key)
+        if cached is not None:
+            _memory_cache.set(key, cached)
+
+    PROMPT_CACHE_TOTAL.inc(result="hit" if cached is not None else "miss")
+    return cached
+
+def _store_expansion(key, expanded):
+    if expanded:
+        _memory_cache.set(key, expanded)
+        if _disk_cache is not None:
+            _disk_cache.set(key, expanded)
+
+def _expansion_input(injection):
+    return [
+        {
+            "role": "user",
+            "content": [
+                { "type": "input_text", "text": PROMPT_ONLY_TEMPLATE + " " + injection },
+            ],
+        }
+    ]
+
+def generate_prompt(mode="image-edit", injection=""):
+    # Getting the Base64 string
+    # base64_image = encode_image(image_path)
+    
+    if mode == "image-edit": return IMAGE_EDIT_PROMPT
+
+    if mode == "prompt-only":
+        key = _cache_key(injection)
+        cached = _cached_expansion(key)
+        if cached is not None:
+            return cached
+
         try:
-            response = client.responses.create(
-                model="gpt-4o",
-                input=[
-                    {
-                        "role": "user",
-                        "content": [
-                            { "type": "input_text", "text": dense_prompt + " " + injection },
-                        ],
-                    }
-                ],
-            )
+            response = openai_limiter.call(PROMPT_MODEL, lambda: openai_client().responses.create(
+                model=PROMPT_MODEL,
+                input=_expansion_input(injection),
+            ))
             
-            return response.output[0].content[0].text
+            expanded = response.output[0].content[0].text
+            _store_expansion(key, expanded)
+            return expanded
+
+        except Exception as e:
+            print(e)
+
+async def generate_prompt_async(mode="image-edit", injection=""):
+    """
+    The asyncio version of generate_prompt, used by the asyncio execution engine.
+    """
+    if mode == "image-edit": return IMAGE_EDIT_PROMPT
+
+    if mode == "prompt-only":
+        key = _cache_key(injection)
+        cached = _cached_expansion(key)
+        if cached is not None:
+            return cached
+
+        try:
+            response = await openai_limiter.call_async(PROMPT_MODEL, lambda: async_openai_client().responses.create(
+                model=PROMPT_MODEL,
+                input=_expansion_input(injection),
+            ))
+
+            expanded = response.output[0].content[0].text
+            _store_expansion(key, expanded)
+            return expanded
 
         except Exception as e:
             print(e)
@@ -0,0 +1,160 @@
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from metrics import STAGE_WAIT_SECONDS
+
+__all__ = [
+    "JobQueue",
+    "QueueFullError",
+    "STAGE_CONCURRENCY",
+    "stage_limit"
+]
+
+WORKER_POOL_SIZE = int(os.getenv("WORKER_POOL_SIZE", 2))
+JOB_QUEUE_MAX_DEPTH = int(os.getenv("JOB_QUEUE_MAX_DEPTH", 20))
+JOB_QUEUE_OVERFLOW = os.getenv("JOB_QUEUE_OVERFLOW", "reject") # reject, drop_oldest, block
+JOB_QUEUE_BLOCK_TIMEOUT = float(os.getenv("JOB_QUEUE_BLOCK_TIMEOUT", 2))
+
+# Per-stage concurrency limits shared by every worker in the process.
+STAGE_CONCURRENCY = {
+    "openai": int(os.getenv("OPENAI_CONCURRENCY", 2)),
+    "slack": int(os.getenv("SLACK_CONCURRENCY", 4)),
+    "dropbox": int(os.getenv("DROPBOX_CONCURRENCY", 4)),
+    "series": int(os.getenv("SERIES_GLOBAL_CONCURRENCY", 4)), # Series variants across all jobs
+}
+STAGE_LIMITS = {stage: threading.BoundedSemaphore(limit) for stage, limit in STAGE_CONCURRENCY.items()}
+
+OVERFLOW_POLICIES = {"reject", "drop_oldest", "block"}
+
+
+class QueueFullError(Exception):
+    """
+        Raised when a job cannot be accepted because the queue is at its maximum depth.
+    """
+
+
+@contextmanager
+def stage_limit(stage):
+    """
+        Holds one slot of the named stage's semaphore for the duration of the block.
+        Unknown stages are not limited.
+    """
+    semaphore = STAGE_LIMITS.get(stage)
+    if semaphore is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    with semaphore:
+        STAGE_WAIT_SECONDS.observe(time.perf_counter() - start, stage=stage)
+        yield
+
+
+class JobQueue:
+    """
+        A bounded queue of callables drained by a fixed pool of worker threads.
+        The overflow policy decides what happens when the queue is full:
+            reject: the new job is refused with a QueueFullError.
+            drop_oldest: the oldest waiting job is discarded to make room, and on_drop(job, args, kwargs) is called with it.
+            block: the caller waits up to block_timeout seconds for room, then the job is refused.
+    """
+    def __init__(self, logger, workers=WORKER_POOL_SIZE, max_depth=JOB_QUEUE_MAX_DEPTH,
+                 overflow=JOB_QUEUE_OVERFLOW, block_timeout=JOB_QUEUE_BLOCK_TIMEOUT):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+
+        self.logger = logger
+        self.workers = workers
+        self.max_depth = max_depth
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.on_drop = None # Set by the owner of the jobs, e.g. DurableJobs, to hear about discarded jobs
+
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._running = 0
+
+    def start(self):
+        """
+            Starts the worker threads. Calling start more than once has no effect.
+        """
+        with self._lock:
+            if self._started:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._started = True
+
+    def submit(self, job, *args, **kwargs):
+        """
+            Places a job on the queue according to the overflow policy.
+            Raises QueueFullError if the job could not be accepted.
+        """
+        self.start()
+        item = (job, args, kwargs)
+
+        if self.overflow == "block":
+            try:
+                self._queue.put(item, timeout=self.block_timeout)
+            except queue.Full:
+                raise QueueFullError("Job queue is full")
+            return
+
+        try:
+            self._queue.put_nowait(item)
+            return
+        except queue.Full:
+            if self.overflow == "reject":
+                raise QueueFullError("Job queue is full")
+
+        # drop_oldest: make room by discarding the job that has waited the longest
+        dropped = None
+        try:
+            with self._lock:
+                try:
+                    dropped = self._queue.get_nowait()
+                    self._queue.task_done()
+                    self.logger.warning("Job queue full, dropped the oldest waiting job.")
+                except queue.Empty:
+                    pass
+                try:
+                    self._queue.put_nowait(item)
+                except queue.Full:
+                    raise QueueFullError("Job queue is full")
+        finally:
+            # Outside the lock, the callback may take its time
+            if dropped is not None and self.on_drop is not None:
+                self.on_drop(*dropped)
+
+    def depth(self):
+        """
+            Returns the number of jobs waiting to be picked up by a worker.
+        """
+        return self._queue.qsize()
+
+    def in_flight(self):
+        """
+            Returns the number of jobs a worker is running.
+        """
+        with self._lock:
+            return self._running
+
+    def _worker(self):
+        while True:
+            job, args, kwargs = self._queue.get()
+            with self._lock:
+                self._running += 1
+            try:
+                job(*args, **kwargs)
+            except Exception as e:
+                self.logger.error(f"Job failed: {e}")
+            finally:
+                with self._lock:
+                    self._running -= 1
+                self._queue.task_done()
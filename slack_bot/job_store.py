@@ -0,0 +1,392 @@
+import os
+import asyncio
+import json
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from job_queue import QueueFullError
+from metrics import JOB_SECONDS, JOBS_TOTAL
+
+__all__ = [
+    "JobStore",
+    "DurableJobs"
+]
+
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "jobs.db")
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 120)) # A claimed job is taken over by another worker after this
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RESUME_INTERVAL = float(os.getenv("JOB_RESUME_INTERVAL", 15)) # Seconds between scans for unfinished jobs
+JOB_STORE_RETENTION = float(os.getenv("JOB_STORE_RETENTION", 7 * 24 * 3600)) # Finished jobs are kept this long
+
+# queued: waiting for a worker, running: leased by a worker, done: finished, dead: gave up after JOB_MAX_ATTEMPTS
+JOB_STATES = ("queued", "running", "done", "dead")
+# Queued, or left running by a worker whose lease ran out while the job has attempts left
+CLAIMABLE = "(state = 'queued' OR (state = 'running' AND lease_expires < ? AND attempts < ?))"
+
+
+def _clear_checkpoints(job_id, path):
+    # checkpoints reads its settings from this module, so it is imported when first needed
+    from checkpoints import Checkpoints
+    Checkpoints(job_id, path=path).clear()
+
+def _purge_checkpoints(path):
+    from checkpoints import Checkpoints
+    Checkpoints.purge(path=path)
+
+
+class JobStore:
+    """
+        Accepted Slack events persisted in SQLite (WAL) so they survive a restart.
+        A worker claims a job by taking a lease on it and renews the lease while it runs.
+        A job whose lease runs out (its worker died) can be claimed again, until it has been attempted
+        max_attempts times; then dead_letter_expired() moves it to the dead state with its last error.
+    """
+    def __init__(self, path=JOB_STORE_PATH, lease_seconds=JOB_LEASE_SECONDS, max_attempts=JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, payload TEXT, state TEXT, attempts INTEGER DEFAULT 0, "
+            "lease_owner TEXT, lease_expires REAL, last_error TEXT, created_at REAL, updated_at REAL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at)")
+
+    def _conn(self):
+        # sqlite3 connections cannot be shared between threads, so keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL") # The ack is only sent once the job is on disk
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _job(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def enqueue(self, job_id, payload):
+        """
+            Durably stores a new job. Returns False if a job with this id already exists.
+        """
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT OR IGNORE INTO jobs (id, payload, state, attempts, created_at, updated_at) "
+            "VALUES (?, ?, 'queued', 0, ?, ?)",
+            (job_id, json.dumps(payload), now, now)
+        )
+        return cursor.rowcount == 1
+
+    def claim(self, owner, job_id=None):
+        """
+            Leases a claimable job to owner and counts the attempt: the given job, or the oldest claimable one.
+            A job is claimable when it is queued, or its lease has expired and it has attempts left.
+            Returns the job, or None if there is nothing to claim.
+        """
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if job_id is None:
+                row = conn.execute(
+                    f"SELECT * FROM jobs WHERE {CLAIMABLE} ORDER BY created_at LIMIT 1", (now, self.max_attempts)
+                ).fetchone()
+            else:
+                row = conn.execute(
+                    f"SELECT * FROM jobs WHERE id = ? AND {CLAIMABLE}", (job_id, now, self.max_attempts)
+                ).fetchone()
+
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            conn.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_owner = ?, "
+                "lease_expires = ?, updated_at = ? WHERE id = ?",
+                (owner, now + self.lease_seconds, now, row["id"])
+            )
+            job = self._job(conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+            conn.execute("COMMIT")
+            return job
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def dead_letter_expired(self):
+        """
+            Moves the jobs whose lease ran out on their last attempt to the dead state and returns them.
+        """
+        now = time.time()
+        expired = "state = 'running' AND lease_expires < ? AND attempts >= ?"
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(f"SELECT * FROM jobs WHERE {expired}", (now, self.max_attempts)).fetchall()
+            conn.execute(
+                "UPDATE jobs SET state = 'dead', lease_owner = NULL, updated_at = ?, "
+                f"last_error = COALESCE(last_error, 'Lease expired') WHERE {expired}",
+                (now, now, self.max_attempts)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return [self._job(row) for row in rows]
+
+    def renew(self, owner, job_ids):
+        """
+            Extends the leases owner holds on the given jobs.
+        """
+        now = time.time()
+        self._conn().executemany(
+            "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND lease_owner = ? AND state = 'running'",
+            [(now + self.lease_seconds, now, job_id, owner) for job_id in job_ids]
+        )
+
+    def complete(self, owner, job_id):
+        self._conn().execute(
+            "UPDATE jobs SET state = 'done', lease_owner = NULL, updated_at = ? WHERE id = ? AND lease_owner = ?",
+            (time.time(), job_id, owner)
+        )
+
+    def fail(self, owner, job_id, error):
+        """
+            Records a failed attempt. The job is queued again, or dead once it has used up its attempts.
+            Returns the job's new state.
+        """
+        conn = self._conn()
+        conn.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'dead' ELSE 'queued' END, "
+            "lease_owner = NULL, last_error = ?, updated_at = ? WHERE id = ? AND lease_owner = ?",
+            (self.max_attempts, str(error), time.time(), job_id, owner)
+        )
+        row = conn.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row["state"] if row else None
+
+    def drop(self, job_id, error):
+        """
+            Moves a job that never got to run to the dead state. Returns False if it was no longer queued.
+        """
+        cursor = self._conn().execute(
+            "UPDATE jobs SET state = 'dead', last_error = ?, updated_at = ? WHERE id = ? AND state = 'queued'",
+            (str(error), time.time(), job_id)
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, job_id):
+        self._conn().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def get(self, job_id):
+        return self._job(self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def claimable_ids(self, limit):
+        now = time.time()
+        rows = self._conn().execute(
+            f"SELECT id FROM jobs WHERE {CLAIMABLE} ORDER BY created_at LIMIT ?", (now, self.max_attempts, limit)
+        ).fetchall()
+        return [row["id"] for row in rows]
+
+    def dead_letters(self, limit=100):
+        rows = self._conn().execute(
+            "SELECT * FROM jobs WHERE state = 'dead' ORDER BY updated_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [self._job(row) for row in rows]
+
+    def counts(self):
+        """
+            Returns the number of jobs in each state.
+        """
+        rows = self._conn().execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall()
+        return {state: 0 for state in JOB_STATES} | {row["state"]: row["n"] for row in rows}
+
+    def purge_finished(self, older_than=JOB_STORE_RETENTION):
+        self._conn().execute(
+            "DELETE FROM jobs WHERE state IN ('done', 'dead') AND updated_at < ?", (time.time() - older_than,)
+        )
+
+
+class DurableJobs:
+    """
+        Runs the jobs of a JobStore on a JobQueue (or AsyncJobQueue).
+        accept() writes the event to the store before it is handed to the queue, so it is never lost once acked.
+        A background thread renews the leases of running jobs and periodically hands unfinished jobs
+        (left by a restart, or queued again after a failure) back to the queue.
+        build_handler(payload, job_id) returns the EventHandler of a job; on_dead(payload) is called when a job gives up,
+        and on_dropped(payload) when a drop_oldest queue discards a job before it ran.
+    """
+    def __init__(self, store, job_queue, build_handler, logger, on_dead=None, on_dropped=None,
+                 resume_interval=JOB_RESUME_INTERVAL):
+        self.store = store
+        self.job_queue = job_queue
+        self.build_handler = build_handler
+        self.logger = logger
+        self.on_dead = on_dead
+        self.on_dropped = on_dropped
+        self.resume_interval = resume_interval
+
+        if hasattr(job_queue, "on_drop"):
+            job_queue.on_drop = self._dropped
+
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._in_flight = set() # Job ids submitted to the queue and not finished yet
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """
+            Starts the lease and resume thread, which also resumes unfinished jobs at startup.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._maintain, name="job-store", daemon=True)
+            self._thread.start()
+
+    def accept(self, job_id, payload):
+        """
+            Stores the job and submits it. Returns False for a job that was already accepted.
+            Raises QueueFullError (after removing the job) if the queue cannot take it.
+        """
+        if not self.store.enqueue(job_id, payload):
+            return False
+        try:
+            self._submit(job_id)
+        except Exception:
+            self.store.delete(job_id)
+            JOBS_TOTAL.inc(outcome="rejected")
+            raise
+        return True
+
+    def _submit(self, job_id):
+        with self._lock:
+            if job_id in self._in_flight:
+                return
+            self._in_flight.add(job_id)
+        try:
+            if getattr(self.job_queue, "runs_coroutines", False):
+                self.job_queue.submit(self._run_async, job_id)
+            else:
+                self.job_queue.submit(self._run, job_id)
+        except Exception:
+            with self._lock:
+                self._in_flight.discard(job_id)
+            raise
+
+    def _dropped(self, job, args, kwargs):
+        """
+            Called by the queue when it discards a job to make room. The job is moved to the dead state so it
+            is neither left queued nor resumed, and the user is told.
+        """
+        job_id = args[0]
+        with self._lock:
+            self._in_flight.discard(job_id)
+        if not self.store.drop(job_id, "Dropped from the full job queue"):
+            return
+        JOBS_TOTAL.inc(outcome="rejected")
+        self.logger.warning(f"Job {job_id} was dropped from the full job queue")
+        if self.on_dropped:
+            self.on_dropped(self.store.get(job_id)["payload"])
+        _clear_checkpoints(job_id, self.store.path)
+
+    def _dead_letter(self, job):
+        self.logger.error(f"Job {job['id']} moved to the dead letter state")
+        if self.on_dead:
+            self.on_dead(job["payload"])
+        # A dead job is never retried, so its artifacts would only fill the scratch dir (RAM by default)
+        _clear_checkpoints(job["id"], self.store.path)
+
+    def _claim(self, job_id):
+        job = self.store.claim(self.owner, job_id)
+        if job is None:
+            # Finished, or another worker holds the lease
+            with self._lock:
+                self._in_flight.discard(job_id)
+            return None
+        if job["attempts"] > 1:
+            self.logger.info(f"Resuming job {job_id}, attempt {job['attempts']}")
+        return job
+
+    def _finish(self, job, started, error=None):
+        try:
+            if error is None:
+                self.store.complete(self.owner, job["id"])
+                JOB_SECONDS.observe(time.perf_counter() - started, outcome="done")
+                JOBS_TOTAL.inc(outcome="done")
+                return
+
+            self.logger.error(f"Job {job['id']} attempt {job['attempts']} failed: {error}")
+            outcome = "dead" if self.store.fail(self.owner, job["id"], error) == "dead" else "retry"
+            JOB_SECONDS.observe(time.perf_counter() - started, outcome=outcome)
+            JOBS_TOTAL.inc(outcome=outcome)
+            if outcome == "dead":
+                self._dead_letter(job)
+        finally:
+            with self._lock:
+                self._in_flight.discard(job["id"])
+
+    def _run(self, job_id):
+        job = self._claim(job_id)
+        if job is None:
+            return
+        started = time.perf_counter()
+        try:
+            self.build_handler(job["payload"], job["id"]).handle_event()
+        except Exception as e:
+            self._finish(job, started, e)
+        else:
+            self._finish(job, started)
+
+    async def _run_async(self, job_id):
+        # The store, and the checkpoints read when the handler is built, are SQLite: keep them off the event loop
+        job = await asyncio.to_thread(self._claim, job_id)
+        if job is None:
+            return
+        started = time.perf_counter()
+        try:
+            handler = await asyncio.to_thread(self.build_handler, job["payload"], job["id"])
+            await handler.handle_event()
+        except Exception as e:
+            await asyncio.to_thread(self._finish, job, started, e)
+        else:
+            await asyncio.to_thread(self._finish, job, started)
+
+    def _maintain(self):
+        last_purge = 0
+        while True:
+            try:
+                with self._lock:
+                    in_flight = list(self._in_flight)
+                if in_flight:
+                    self.store.renew(self.owner, in_flight)
+
+                # Jobs whose worker died during their last attempt
+                for job in self.store.dead_letter_expired():
+                    JOBS_TOTAL.inc(outcome="dead")
+                    self._dead_letter(job)
+
+                room = max(0, self.job_queue.max_depth - self.job_queue.depth())
+                for job_id in self.store.claimable_ids(room + len(in_flight)):
+                    try:
+                        self._submit(job_id)
+                    except QueueFullError:
+                        break
+
+                if time.time() - last_purge > 3600:
+                    self.store.purge_finished()
+                    _purge_checkpoints(self.store.path)
+                    last_purge = time.time()
+            except Exception as e:
+                self.logger.error(f"Job store maintenance failed: {e}")
+
+            time.sleep(min(self.resume_interval, self.store.lease_seconds / 3))
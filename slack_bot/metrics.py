@@ -0,0 +1,222 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "render",
+    "add_observer",
+    "track_stage",
+    "STAGE_SECONDS",
+    "STAGE_TOTAL",
+    "STAGE_WAIT_SECONDS",
+    "JOB_SECONDS",
+    "JOBS_TOTAL",
+    "RETRIES_TOTAL",
+    "CONTENT_TYPE"
+]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Stages range from a few milliseconds (a checkpoint read) to minutes (gpt-image-1 under load)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+JOB_BUCKETS = (1, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600, 1200)
+
+_metrics = []
+_observers = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """
+        A named family of series told apart by their label values, in the Prometheus text format.
+        Every metric registers itself so render() can serve it.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in sorted(self._values.items())]
+
+    def snapshot(self):
+        """
+            Returns the current value of every series, keyed by its label values.
+        """
+        with self._lock:
+            return {key: value for key, value in self._values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+        A value that goes up and down. A gauge built with a callback reads its values when scraped:
+        callback() returns a number, or a dict of label value tuples to numbers.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        if self.callback is None:
+            return super()._samples()
+        try:
+            values = self.callback()
+        except Exception as e:
+            print(f"Gauge {self.name} could not be read: {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, tuple(str(v) for v in key), (), value) for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+        for observer in _observers:
+            observer(self.name, labels, value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", key, (("le", _format_value(bound)),), count))
+                samples.append((f"{self.name}_sum", key, (), total))
+                samples.append((f"{self.name}_count", key, (), counts[-1]))
+        return samples
+
+
+def add_observer(observer):
+    """
+        Calls observer(name, labels, value) with every histogram observation, for tools that need the raw values
+        (bench_pipeline.py computes exact percentiles from them).
+    """
+    _observers.append(observer)
+
+
+def render():
+    """
+        Returns every registered metric in the Prometheus text exposition format.
+    """
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "slackbot_stage_seconds", "Time spent in each pipeline stage, excluding the wait for a stage slot.", ("stage",)
+)
+STAGE_TOTAL = Counter("slackbot_stage_total", "Pipeline stage runs by outcome.", ("stage", "outcome"))
+STAGE_WAIT_SECONDS = Histogram(
+    "slackbot_stage_wait_seconds", "Time spent waiting for a slot of a concurrency limited stage.", ("stage",)
+)
+JOB_SECONDS = Histogram("slackbot_job_seconds", "Duration of one attempt of a job.", ("outcome",), buckets=JOB_BUCKETS)
+JOBS_TOTAL = Counter("slackbot_jobs_total", "Jobs by outcome: done, retry, dead or rejected.", ("outcome",))
+RETRIES_TOTAL = Counter("slackbot_retries_total", "Calls to an outside service that were retried.", ("service",))
+PROMPT_CACHE_TOTAL = Counter("slackbot_prompt_cache_total", "Prompt expansion cache lookups by result: hit or miss.", ("result",))
+
+
+class _StageRun:
+    failed = False
+
+    def fail(self):
+        """
+            Counts the run as an error although the block returned, for helpers that report errors as values.
+        """
+        self.failed = True
+
+
+@contextmanager
+def track_stage(stage):
+    """
+        Times the block as one run of the stage and counts it as ok, or error if it raised or was marked failed.
+        Used inside the stage's stage_limit, so the time does not include waiting for a slot.
+        Downloads are the exception: they take their slot per attempt, so their time includes the waits.
+    """
+    run = _StageRun()
+    outcome = "error"
+    start = time.perf_counter()
+    try:
+        yield run
+        if not run.failed:
+            outcome = "ok"
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+        STAGE_TOTAL.inc(stage=stage, outcome=outcome)
@@ -0,0 +1,169 @@
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image, ImageChops
+
+__all__ = [
+    "ENCODER_PROFILES",
+    "encode_png",
+    "save_png"
+]
+
+# compress_level and compress_type (the zlib strategy) are passed to Pillow's encoder.
+# filter is only used by the parallel encoder, Pillow chooses its own PNG row filters.
+ENCODER_PROFILES = {
+    "fast": {"compress_level": 1, "compress_type": zlib.Z_RLE, "filter": "sub"},
+    "balanced": {"compress_level": 6, "compress_type": zlib.Z_DEFAULT_STRATEGY, "filter": "up"},
+    "smallest": {"compress_level": 9, "compress_type": zlib.Z_DEFAULT_STRATEGY, "filter": "up", "optimize": True},
+}
+
+PNG_PROFILE = os.getenv("PNG_PROFILE", "balanced")
+PNG_ENCODER = os.getenv("PNG_ENCODER", "pillow") # pillow, parallel
+PNG_ENCODER_THREADS = int(os.getenv("PNG_ENCODER_THREADS", os.cpu_count() or 1))
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_TYPES = {"L": 0, "RGB": 2, "LA": 4, "RGBA": 6}
+PNG_FILTERS = {"none": 0, "sub": 1, "up": 2}
+IDAT_CHUNK_SIZE = 1024 * 1024
+
+
+def _chunk(chunk_type, data):
+    return (
+        struct.pack(">I", len(data)) + chunk_type + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff)
+    )
+
+
+def _adler32_combine(adler1, adler2, len2):
+    """
+    Combines the adler32 of two consecutive byte strings, the same way zlib's adler32_combine does.
+    """
+    base = 65521
+    rem = len2 % base
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % base
+    sum1 += (adler2 & 0xffff) + base - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + base - rem
+    if sum1 >= base:
+        sum1 -= base
+    if sum1 >= base:
+        sum1 -= base
+    if sum2 >= (base << 1):
+        sum2 -= (base << 1)
+    if sum2 >= base:
+        sum2 -= base
+    return sum1 | (sum2 << 16)
+
+
+def _filtered_band(image, top, bottom, png_filter):
+    """
+    Returns the raw PNG scanlines of rows top to bottom, each prefixed with its filter type byte.
+    The Sub and Up filters are the per byte difference (mod 256) with the pixel to the left or above,
+    which is what ImageChops.subtract_modulo computes per band.
+    """
+    width = image.size[0]
+    band = image.crop((0, top, width, bottom))
+
+    if png_filter == "up":
+        previous = Image.new(image.mode, band.size, 0)
+        if top > 0:
+            previous.paste(image.crop((0, top - 1, width, bottom - 1)), (0, 0))
+        else:
+            previous.paste(image.crop((0, 0, width, bottom - 1)), (0, 1))
+        band = ImageChops.subtract_modulo(band, previous)
+    elif png_filter == "sub":
+        previous = Image.new(image.mode, band.size, 0)
+        previous.paste(band.crop((0, 0, width - 1, bottom - top)), (1, 0))
+        band = ImageChops.subtract_modulo(band, previous)
+
+    raw = band.tobytes()
+    stride = len(raw) // (bottom - top)
+    filter_byte = bytes([PNG_FILTERS[png_filter]])
+    return b"".join(filter_byte + raw[i:i + stride] for i in range(0, len(raw), stride))
+
+
+def _compress_band(image, top, bottom, png_filter, level, strategy, last):
+    data = _filtered_band(image, top, bottom, png_filter)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, strategy)
+    # A sync flush ends the band on a byte boundary so the raw deflate streams can be concatenated
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.adler32(data), len(data)
+
+
+def _encode_parallel(image, out, dpi, profile, threads):
+    """
+    Writes a PNG whose image data is deflated in horizontal bands on several threads.
+    zlib releases the GIL while compressing, so the bands are compressed in parallel
+    and stitched into one valid zlib stream.
+    """
+    if image.mode not in PNG_COLOR_TYPES:
+        image = image.convert("RGBA")
+
+    width, height = image.size
+    level = profile["compress_level"]
+    strategy = profile["compress_type"]
+    png_filter = profile.get("filter", "none")
+
+    bands = max(1, min(threads * 2, height))
+    rows = -(-height // bands)
+    bounds = [(top, min(top + rows, height)) for top in range(0, height, rows)]
+
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(
+            lambda b: _compress_band(image, b[0], b[1], png_filter, level, strategy, b[1] == height),
+            bounds
+        ))
+
+    adler = 1
+    for _, band_adler, band_length in results:
+        adler = _adler32_combine(adler, band_adler, band_length)
+
+    out.write(PNG_SIGNATURE)
+    out.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[image.mode], 0, 0, 0)))
+    if dpi:
+        ppm = (int(dpi[0] / 0.0254 + 0.5), int(dpi[1] / 0.0254 + 0.5))
+        out.write(_chunk(b"pHYs", struct.pack(">IIB", ppm[0], ppm[1], 1)))
+
+    stream = b"\x78\x9c" + b"".join(compressed for compressed, _, _ in results) + struct.pack(">I", adler)
+    for i in range(0, len(stream), IDAT_CHUNK_SIZE):
+        out.write(_chunk(b"IDAT", stream[i:i + IDAT_CHUNK_SIZE]))
+    out.write(_chunk(b"IEND", b""))
+
+
+def save_png(image, destination, dpi=(300, 300), profile=None, encoder=None, threads=None):
+    """
+    Encodes the image as a PNG to a path or a writable binary buffer.
+    profile names one of ENCODER_PROFILES (PNG_PROFILE by default).
+    encoder is "pillow" or "parallel" (PNG_ENCODER by default).
+    """
+    settings = ENCODER_PROFILES[profile or PNG_PROFILE]
+    encoder = encoder or PNG_ENCODER
+
+    if encoder == "parallel":
+        if hasattr(destination, "write"):
+            _encode_parallel(image, destination, dpi, settings, threads or PNG_ENCODER_THREADS)
+        else:
+            with open(destination, "wb") as f:
+                _encode_parallel(image, f, dpi, settings, threads or PNG_ENCODER_THREADS)
+        return
+
+    image.save(
+        destination,
+        format="PNG",
+        dpi=dpi,
+        compress_level=settings["compress_level"],
+        compress_type=settings["compress_type"],
+        optimize=settings.get("optimize", False)
+    )
+
+
+def encode_png(image, dpi=(300, 300), profile=None, encoder=None, threads=None):
+    """
+    Encodes the image as a PNG into an in-memory buffer, rewound and ready to be read.
+    """
+    buffer = BytesIO()
+    save_png(image, buffer, dpi, profile, encoder, threads)
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,56 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+
+def import_times(module, cwd):
+    """
+    Imports the module in a fresh interpreter with -X importtime and returns
+    (name, self seconds, cumulative seconds, depth) for every module it loaded, in import order.
+    """
+    env = {**os.environ, "PYTHONDONTWRITEBYTECODE": "1"}
+    env.setdefault("OPENAI_API_KEY", "profile") # Only needed if a client gets created at import
+    # Run from a scratch directory so importing app does not touch the real job store or log
+    with tempfile.TemporaryDirectory() as scratch:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {cwd!r}); import {module}"],
+            cwd=scratch, env=env, capture_output=True, text=True
+        )
+    if result.returncode != 0:
+        raise SystemExit(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6, depth))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show how long each module takes to import at startup.")
+    parser.add_argument("module", nargs="?", default="app", help="Module to import, app by default")
+    parser.add_argument("--top", type=int, default=25, help="Number of slowest modules to list")
+    parser.add_argument("--local", action="store_true", help="Only list the bot's own modules")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    local = {name[:-3] for name in os.listdir(here) if name.endswith(".py")}
+    times = import_times(args.module, here)
+    total = next((cumulative for name, _, cumulative, _ in times if name == args.module), 0)
+
+    rows = [row for row in times if not args.local or row[0] in local]
+    rows.sort(key=lambda row: row[2], reverse=True)
+
+    print(f"import {args.module}: {total:.3f}s\n")
+    print(f"{'module':<50} {'self s':>8} {'total s':>8} {'share':>6}")
+    for name, self_seconds, cumulative, depth in rows[:args.top]:
+        print(f"{name[:50]:<50} {self_seconds:>8.3f} {cumulative:>8.3f} {cumulative / total if total else 0:>6.0%}")
+
+
+if __name__ == "__main__":
+    main()
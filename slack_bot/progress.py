@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+from slack_helper import post_message, update_message
+
+__all__ = ["StatusMessage"]
+
+STATUS_UPDATE_INTERVAL = float(os.getenv("STATUS_UPDATE_INTERVAL", 1.5)) # Slack allows about one message per second per channel
+STATUS_MAX_LINES = int(os.getenv("STATUS_MAX_LINES", 20))
+STATUS_MAX_LINE_LENGTH = int(os.getenv("STATUS_MAX_LINE_LENGTH", 500)) # Keeps the message well under Slack's text limit
+
+
+class StatusMessage:
+    """
+        A single Slack message per job that shows the job's progress.
+        The first update posts the message; later updates edit it in place with chat_update.
+        Updates arriving within STATUS_UPDATE_INTERVAL of the last edit are merged into one edit, sent by a timer.
+        Posts and edits are queued on the Slack dispatcher, so the caller never waits on Slack.
+        Only the last max_lines lines are shown, each cut to max_line_length characters, so the message never
+        grows past what chat_update accepts.
+    """
+    def __init__(self, channel_id, interval=STATUS_UPDATE_INTERVAL, max_lines=STATUS_MAX_LINES,
+                 max_line_length=STATUS_MAX_LINE_LENGTH):
+        self.channel_id = channel_id
+        self.interval = interval
+        self.max_lines = max_lines
+        self.max_line_length = max_line_length
+
+        self.lines = []
+        self.hidden_lines = 0
+        self.ts = None
+        self._last_flush = 0
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock() # Keeps edits in order
+
+    def update(self, line):
+        """
+            Adds a line to the status message.
+        """
+        if len(line) > self.max_line_length:
+            line = line[:self.max_line_length - 1] + "…"
+
+        with self._lock:
+            self.lines.append(line)
+            if len(self.lines) > self.max_lines:
+                self.hidden_lines += len(self.lines) - self.max_lines
+                del self.lines[:-self.max_lines]
+            self._dirty = True
+
+            wait = self._last_flush + self.interval - time.monotonic()
+            if self.ts is not None and wait > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+
+        self._flush()
+
+    def close(self):
+        """
+            Sends any pending lines. Called when the job ends.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self._flush()
+
+    def _flush(self):
+        with self._send_lock:
+            with self._lock:
+                self._timer = None
+                if not self._dirty:
+                    return
+                lines = self.lines
+                if self.hidden_lines:
+                    lines = [f"… {self.hidden_lines} earlier update(s)"] + lines
+                text = "\n".join(lines)
+                self._dirty = False
+                self._last_flush = time.monotonic()
+                ts = self.ts
+
+            if ts is None:
+                ts = post_message(self.channel_id, text)
+                with self._lock:
+                    self.ts = ts
+            else:
+                update_message(self.channel_id, ts, text)
@@ -0,0 +1,198 @@
+import os
+import asyncio
+import json
+import random
+import threading
+import time
+from metrics import RETRIES_TOTAL
+
+__all__ = [
+    "TokenBucket",
+    "RateLimiter",
+    "openai_limiter"
+]
+
+# Requests per minute (rpm) and images per minute (ipm) for each model, overridable with OPENAI_RATE_LIMITS
+DEFAULT_RATE_LIMITS = {
+    "gpt-image-1": {"rpm": 20, "ipm": 5},
+    "dall-e-2": {"rpm": 50, "ipm": 50},
+    "gpt-4o": {"rpm": 500},
+}
+OPENAI_RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **json.loads(os.getenv("OPENAI_RATE_LIMITS", "{}"))}
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+OPENAI_MAX_BACKOFF = float(os.getenv("OPENAI_MAX_BACKOFF", 60))
+
+
+class TokenBucket:
+    """
+        A token bucket refilled at per_minute tokens per minute.
+        Callers are served in arrival order, so a waiting job is never overtaken by a newer one.
+        pause() empties the bucket for a while, which is how a server side 429 slows every caller down.
+    """
+    def __init__(self, per_minute):
+        self.capacity = max(1, per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        """
+            Blocks until amount tokens are available and takes them.
+        """
+        amount = min(amount, self.capacity)
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                if ticket != self._serving:
+                    self._cond.wait()
+                    continue
+
+                if now < self.paused_until:
+                    self._cond.wait(self.paused_until - now)
+                    continue
+
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    self._serving += 1
+                    self._cond.notify_all()
+                    return
+
+                self._cond.wait((amount - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        with self._cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self._cond.notify_all()
+
+
+class RateLimiter:
+    """
+        Process-wide request and image limits per model.
+        call() waits for capacity, runs the request and retries it after a 429 or a transient error,
+        backing off for as long as the server asks (retry-after) or exponentially otherwise.
+    """
+    def __init__(self, limits=OPENAI_RATE_LIMITS, max_retries=OPENAI_MAX_RETRIES):
+        self.limits = limits
+        self.max_retries = max_retries
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, model, kind):
+        limit = self.limits.get(model, {}).get(kind)
+        if not limit:
+            return None
+
+        with self._lock:
+            key = (model, kind)
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(limit)
+            return self._buckets[key]
+
+    def acquire(self, model, images=0):
+        requests_bucket = self._bucket(model, "rpm")
+        if requests_bucket:
+            requests_bucket.acquire(1)
+
+        images_bucket = self._bucket(model, "ipm")
+        if images and images_bucket:
+            images_bucket.acquire(images)
+
+    def backoff(self, model, seconds):
+        for kind in ("rpm", "ipm"):
+            bucket = self._bucket(model, kind)
+            if bucket:
+                bucket.pause(seconds)
+
+    @staticmethod
+    def retry_after(error):
+        """
+            Reads the server's retry hint from a rate limit error, in seconds.
+        """
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+        return None
+
+    @staticmethod
+    def is_rate_limited(error):
+        return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+    @staticmethod
+    def is_transient(error):
+        """
+            Server errors, timeouts and dropped connections are worth retrying as well.
+        """
+        status_code = getattr(error, "status_code", None)
+        if status_code is not None:
+            return status_code in (408, 409) or status_code >= 500
+        return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+    def _retry_delay(self, model, error, attempt):
+        """
+            Decides whether a failed request is retried. Re-raises the error if not,
+            otherwise returns how long the caller should sleep before trying again.
+        """
+        rate_limited = self.is_rate_limited(error)
+        if not (rate_limited or self.is_transient(error)) or attempt == self.max_retries:
+            raise error
+
+        RETRIES_TOTAL.inc(service="openai")
+        delay = self.retry_after(error)
+        if delay is None:
+            delay = min(OPENAI_MAX_BACKOFF, 2 ** attempt) + random.random()
+
+        if rate_limited:
+            # Every caller of this model waits, not just this one
+            print(f"Rate limited by OpenAI for {model}, retrying in {delay:.1f}s")
+            self.backoff(model, delay)
+            return 0
+
+        print(f"OpenAI request failed ({error}), retrying in {delay:.1f}s")
+        return delay
+
+    def call(self, model, request, images=0):
+        """
+            Runs request() within the model's limits and returns its result.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(model, images)
+            try:
+                return request()
+            except Exception as e:
+                time.sleep(self._retry_delay(model, e, attempt))
+
+    async def call_async(self, model, request, images=0):
+        """
+            The asyncio version of call(): request() returns an awaitable.
+            Waiting for capacity happens on a worker thread so the event loop keeps running.
+        """
+        for attempt in range(self.max_retries + 1):
+            await asyncio.to_thread(self.acquire, model, images)
+            try:
+                return await request()
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(model, e, attempt))
+
+
+openai_limiter = RateLimiter()
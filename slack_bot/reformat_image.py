@@ -1,25 +1,146 @@
 from PIL import Image
 import os
 import pathlib
-import numpy as np
+import resource
+import sys
+import threading
 
 from io import BytesIO
+from png_encoder import save_png
 
-def resize_image(image_bytes, new_size: tuple = (4500, 5400), crop_margin=6):
-    # Suppose image_bytes contains your raw bytes (from base64 or download)
-    image = Image.open(BytesIO(image_bytes))
+RESAMPLE_FILTERS = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+RESIZE_FILTER = os.getenv("RESIZE_FILTER", "bicubic")
+
+def _bytes_per_pixel(image):
+    # Pillow keeps multi-band 8-bit images (RGB included) at 4 bytes per pixel
+    if len(image.getbands()) > 1 or image.mode in ("I", "F"):
+        return 4
+    return 2 if image.mode.startswith("I;16") else 1
+
+def _image_nbytes(image):
+    """
+    Size of the decoded pixel buffer of an image.
+    """
     width, height = image.size
-    top, left = crop_margin, crop_margin
+    return width * height * _bytes_per_pixel(image)
+
+def _process_max_rss_bytes():
+    # The RSS high-water mark of the whole process since it started, not of any one call.
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def _current_rss_bytes():
+    # Resident set size right now, from /proc (Linux only), None where it cannot be read
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return None
+
+class _PeakRssSampler:
+    """
+    Samples the process RSS while the block runs and keeps the highest reading.
+    Pillow releases the GIL while it resamples, so the sampler sees the intermediate buffer.
+    The RSS belongs to the whole process, so other jobs running at the same time are counted too.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start_bytes = None
+        self.peak_bytes = None
+        self._done = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while True:
+            rss = _current_rss_bytes()
+            if rss is not None:
+                self.peak_bytes = max(self.peak_bytes or 0, rss)
+            if self._done.wait(self.interval):
+                return
 
-    bottom = height - crop_margin
-    right = width - crop_margin
+    def __enter__(self):
+        self.start_bytes = self.peak_bytes = _current_rss_bytes()
+        if self.start_bytes is not None:
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
 
-    image = np.array(image)
+    def __exit__(self, *exc):
+        if self._thread:
+            self._done.set()
+            self._thread.join()
+        return False
 
-    image = image[top:bottom, left:right]
+    @property
+    def growth_bytes(self):
+        """
+        How far the RSS rose above its level at the start of the block, None where RSS cannot be read.
+        """
+        if self.start_bytes is None:
+            return None
+        return max(0, self.peak_bytes - self.start_bytes)
 
-    image = Image.fromarray(image)
-    return image.resize(new_size)
+def resize_image_with_stats(image_bytes, new_size: tuple = (4500, 5400), crop_margin=6, resample=None):
+    """
+    Crops crop_margin pixels off every edge and scales the image to new_size in a single pass.
+    resample names one of RESAMPLE_FILTERS and defaults to RESIZE_FILTER.
+    The crop is applied as the source box of the resize, so the cropped region is never copied.
+    Pillow still resamples in two passes, through an intermediate image as wide as the output
+    and as tall as the source box.
+    Returns the resized image and a dict describing the memory used by the call.
+    peak_rss_growth_bytes is measured: how far the process RSS rose during the call (None off Linux).
+    estimated_buffer_bytes adds up the buffers the call holds at once, it is an estimate.
+    process_max_rss_bytes is the process's lifetime RSS high-water mark, for context only.
+    """
+    filter_name = (resample or RESIZE_FILTER).lower()
+    resample = RESAMPLE_FILTERS[filter_name]
+
+    with _PeakRssSampler() as sampler:
+        if isinstance(image_bytes, Image.Image):
+            image = image_bytes
+            input_bytes = 0
+        else:
+            image = Image.open(BytesIO(image_bytes))
+            input_bytes = len(image_bytes)
+
+        # Palette images would be resized as raw indices, resize the colours instead
+        if image.mode == "P":
+            image = image.convert("RGBA")
+
+        width, height = image.size
+        box = (crop_margin, crop_margin, width - crop_margin, height - crop_margin)
+
+        resized = image.resize(new_size, resample=resample, box=box)
+
+    decoded_bytes = _image_nbytes(image)
+    output_bytes = _image_nbytes(resized)
+    # The horizontal pass writes an image as wide as the output over the rows of the source box
+    intermediate_bytes = new_size[0] * (box[3] - box[1]) * _bytes_per_pixel(image)
+    stats = {
+        "input_bytes": input_bytes,
+        "decoded_bytes": decoded_bytes,
+        "intermediate_bytes": intermediate_bytes,
+        "output_bytes": output_bytes,
+        "estimated_buffer_bytes": input_bytes + decoded_bytes + intermediate_bytes + output_bytes,
+        "peak_rss_growth_bytes": sampler.growth_bytes,
+        "process_max_rss_bytes": _process_max_rss_bytes(),
+        "filter": filter_name,
+    }
+    return resized, stats
+
+def resize_image(image_bytes, new_size: tuple = (4500, 5400), crop_margin=6, resample=None):
+    # Suppose image_bytes contains your raw bytes (from base64 or download)
+    resized, _ = resize_image_with_stats(image_bytes, new_size, crop_margin, resample)
+    return resized
 
 def main():
     images = os.listdir("image_outputs")
@@ -39,7 +160,7 @@ def main():
 
         resized_image = resize_image(resized_image)
 
-        resized_image.save(pathlib.Path(f"image_outputs/{images[i]}"), dpi=(300, 300))
+        save_png(resized_image, pathlib.Path(f"image_outputs/{images[i]}"))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,104 @@
+import os
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+
+__all__ = ["ResultCache", "hash_image"]
+
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "result_cache")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+
+def hash_image(input_image):
+    """
+    Returns the sha256 of an image given as bytes or as a file path, or "" when there is no input image.
+    """
+    if input_image is None:
+        return ""
+    if isinstance(input_image, (bytes, bytearray)):
+        return hashlib.sha256(input_image).hexdigest()
+
+    digest = hashlib.sha256()
+    with open(input_image, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+        Content-addressed store of final, resized outputs.
+        Entries are keyed on the input image hash, the final prompt, the model and the output size,
+        so the same request never pays for a second generation.
+        The least recently used entries are evicted once the store grows past max_bytes.
+    """
+    def __init__(self, directory=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(input_hash, prompt, model, size):
+        raw = json.dumps([input_hash, prompt, model, size])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get(self, key):
+        """
+            Returns the path of the cached output, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            os.utime(path) # Mark as recently used
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, output):
+        """
+            Stores an output given as a file path or a binary buffer, then evicts old entries if needed.
+            The directory is created with the first entry.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if hasattr(output, "read"):
+                    output.seek(0)
+                    shutil.copyfileobj(output, f)
+                    output.seek(0)
+                else:
+                    with open(output, "rb") as source:
+                        shutil.copyfileobj(source, f)
+            os.replace(partial, self._path(key))
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(".png"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                    total -= size
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,170 @@
+import os
+import json
+import queue
+import random
+import socket
+import threading
+import time
+import urllib.error
+from concurrent.futures import Future
+from slack_sdk.errors import SlackApiError
+from rate_limiter import TokenBucket
+from metrics import track_stage, RETRIES_TOTAL
+
+__all__ = ["SlackDispatcher"]
+
+# Calls per minute allowed for each Web API method across the workspace, overridable with SLACK_RATE_LIMITS.
+# https://api.slack.com/apis/rate-limits (chat.update is tier 3, file uploads tier 4 but we keep them well below)
+DEFAULT_SLACK_RATE_LIMITS = {
+    "chat_postMessage": 60,
+    "chat_update": 50,
+    "files_upload_v2": 20,
+}
+SLACK_RATE_LIMITS = {**DEFAULT_SLACK_RATE_LIMITS, **json.loads(os.getenv("SLACK_RATE_LIMITS", "{}"))}
+SLACK_CHANNEL_INTERVAL = float(os.getenv("SLACK_CHANNEL_INTERVAL", 1)) # Slack allows about one message per second per channel
+SLACK_MAX_RETRIES = int(os.getenv("SLACK_MAX_RETRIES", 5))
+SLACK_MAX_BACKOFF = float(os.getenv("SLACK_MAX_BACKOFF", 60))
+
+TRANSIENT_ERRORS = {"ratelimited", "internal_error", "fatal_error", "service_unavailable", "request_timeout"}
+
+
+class SlackDispatcher:
+    """
+        Sends Web API calls from a queue per channel, so posting never blocks the pipeline.
+        Each channel's queue is drained in order by its own thread, at most one call every channel_interval seconds,
+        and every method shares a workspace wide token bucket sized to its tier.
+        A 429 pauses the channel and the method for as long as Slack's Retry-After asks,
+        transient errors are retried with exponential backoff.
+        submit() returns a Future holding the API response, or the error once retries are exhausted.
+        client_factory() returns the WebClient; it is called on the dispatch threads, so the client is
+        only created once something is sent.
+    """
+    def __init__(self, client_factory, limits=SLACK_RATE_LIMITS, channel_interval=SLACK_CHANNEL_INTERVAL,
+                 max_retries=SLACK_MAX_RETRIES):
+        self.client_factory = client_factory
+        self.channel_interval = channel_interval
+        self.max_retries = max_retries
+
+        self._buckets = {method: TokenBucket(limit) for method, limit in limits.items()}
+        self._queues = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def submit(self, channel_id, method, **kwargs):
+        """
+            Queues client.<method>(**kwargs) for the channel and returns a Future of its response.
+            Keyword values that are Futures (e.g. the ts of a message still queued) are resolved just before the call.
+        """
+        future = Future()
+        with self._lock:
+            if channel_id not in self._queues:
+                self._queues[channel_id] = queue.Queue()
+                self._pending[channel_id] = 0
+                thread = threading.Thread(
+                    target=self._worker, args=(channel_id,), name=f"slack-dispatch-{channel_id}", daemon=True
+                )
+                thread.start()
+            self._pending[channel_id] += 1
+            self._queues[channel_id].put((method, kwargs, future))
+        return future
+
+    def depth(self, channel_id=None):
+        """
+            Returns the number of calls queued or in flight, for one channel or for all of them.
+        """
+        with self._lock:
+            if channel_id is not None:
+                return self._pending.get(channel_id, 0)
+            return sum(self._pending.values())
+
+    def depths(self):
+        with self._lock:
+            return dict(self._pending)
+
+    def wait_idle(self, timeout=None):
+        """
+            Blocks until every queued call has been sent. Returns False if the timeout expired first.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not any(self._pending.values()), timeout)
+
+    @staticmethod
+    def retry_after(error):
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        value = headers.get("Retry-After") or headers.get("retry-after")
+        try:
+            return float(value) if value else None
+        except ValueError:
+            return None
+
+    @staticmethod
+    def is_rate_limited(error):
+        response = getattr(error, "response", None)
+        return getattr(response, "status_code", None) == 429 or (
+            isinstance(error, SlackApiError) and error.response.get("error") == "ratelimited"
+        )
+
+    @staticmethod
+    def is_transient(error):
+        """
+            Slack server errors, timeouts and dropped connections are worth retrying.
+        """
+        if isinstance(error, SlackApiError):
+            status_code = getattr(error.response, "status_code", 200)
+            return status_code >= 500 or error.response.get("error") in TRANSIENT_ERRORS
+        # Not every OSError: a missing or unreadable upload file fails the same way on every attempt
+        return isinstance(error, (ConnectionError, TimeoutError, socket.timeout, urllib.error.URLError))
+
+    def _worker(self, channel_id):
+        calls = self._queues[channel_id]
+        last_sent = 0
+        while True:
+            method, kwargs, future = calls.get()
+            try:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                wait = last_sent + self.channel_interval - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    future.set_result(self._call(channel_id, method, kwargs))
+                except Exception as e:
+                    print(f"Slack {method} to {channel_id} failed: {e}")
+                    future.set_exception(e)
+                last_sent = time.monotonic()
+            finally:
+                with self._idle:
+                    self._pending[channel_id] -= 1
+                    self._idle.notify_all()
+
+    def _call(self, channel_id, method, kwargs):
+        kwargs = {key: value.result() if isinstance(value, Future) else value for key, value in kwargs.items()}
+        bucket = self._buckets.get(method)
+
+        for attempt in range(self.max_retries + 1):
+            if bucket:
+                bucket.acquire()
+            try:
+                # Timed per attempt, after the pacing waits, under the Web API method's name
+                with track_stage(method):
+                    return getattr(self.client_factory(), method)(**kwargs)
+            except Exception as e:
+                rate_limited = self.is_rate_limited(e)
+                if not (rate_limited or self.is_transient(e)) or attempt == self.max_retries:
+                    raise
+
+                RETRIES_TOTAL.inc(service="slack")
+
+                delay = self.retry_after(e)
+                if delay is None:
+                    delay = min(SLACK_MAX_BACKOFF, 2 ** attempt) + random.random()
+
+                if rate_limited:
+                    print(f"Rate limited by Slack on {method}, retrying in {delay:.1f}s")
+                    if bucket:
+                        bucket.pause(delay) # Every channel using this method waits
+                else:
+                    print(f"Slack {method} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
@@ -1,26 +1,45 @@
 import os
+import hashlib
+import time
+from concurrent.futures import Future
 import requests
-from dotenv import load_dotenv
-from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
-
-load_dotenv()
+from clients import slack_client, slack_http_session, SLACK_POOL_SIZE
+from slack_dispatcher import SlackDispatcher
+from metrics import RETRIES_TOTAL
+from job_queue import stage_limit
 
 __all__ = [
     "get_channel_id",
     "send_message",
     "download_slack_file",
-    "send_file"
+    "send_file",
+    "post_message",
+    "update_message",
+    "dispatcher",
+    "SlackDownloadError"
 ]
 
 SLACK_TOKEN = os.getenv("SLACK_TOKEN")
+SLACK_DOWNLOAD_TIMEOUT = (10, float(os.getenv("SLACK_DOWNLOAD_TIMEOUT", 60))) # (connect, read) seconds
+SLACK_DOWNLOAD_RETRIES = int(os.getenv("SLACK_DOWNLOAD_RETRIES", 3))
+SLACK_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Every outbound message and upload goes through here, paced per channel and per method.
+# The WebClient itself is only created when the first call is sent.
+dispatcher = SlackDispatcher(slack_client)
 
-client = WebClient(token=SLACK_TOKEN, timeout=180)
+class SlackDownloadError(Exception):
+    """
+        Raised when a Slack file could not be downloaded completely.
+    """
 
 def get_all_channel_ids():
     channels = {}
     try:
-        for result in client.conversations_list(types="public_channel,private_channel"):
+        for result in slack_client().conversations_list(types="public_channel,private_channel"):
             for channel in result["channels"]:
                 channels[channel["name"]] = channel["id"]
         return channels
@@ -31,7 +50,7 @@ def get_channel_id(channel_name):
     conversation_id = None
     try:
         # Call the conversations.list method using the WebClient
-        for result in client.conversations_list():
+        for result in slack_client().conversations_list():
             if conversation_id is not None:
                 break
             for channel in result["channels"]:
@@ -44,44 +63,139 @@ def get_channel_id(channel_name):
         print(f"Error: {e}")
 
 def send_message(channel_id, message):
-    try:
-        # Call the conversations.list method using the WebClient
-        result = client.chat_postMessage(
-            channel=channel_id,
-            text=message
-            # You could also use a blocks[] array to send richer content
-        )
+    """
+        Queues a message for the channel and returns at once.
+        Returns a Future of the API response; errors are logged by the dispatcher.
+    """
+    return dispatcher.submit(channel_id, "chat_postMessage", text=message, channel=channel_id)
 
-    except SlackApiError as e:
-        print(f"Error: {e}")
+def post_message(channel_id, message):
+    """
+        Queues a message and returns a Future of its timestamp, which identifies it for later updates.
+        The Future can be passed straight to update_message.
+    """
+    ts = Future()
+    def resolve(response):
+        if response.exception():
+            ts.set_exception(response.exception())
+        else:
+            ts.set_result(response.result()["ts"])
+
+    send_message(channel_id, message).add_done_callback(resolve)
+    return ts
+
+def update_message(channel_id, ts, message):
+    """
+        Queues a replacement of the text of a message posted earlier. ts may be a Future from post_message.
+    """
+    return dispatcher.submit(channel_id, "chat_update", channel=channel_id, ts=ts, text=message)
+
+def _stream_to(response, out, digest):
+    written = 0
+    for chunk in response.iter_content(chunk_size=SLACK_DOWNLOAD_CHUNK_SIZE):
+        if chunk:
+            out.write(chunk)
+            digest.update(chunk)
+            written += len(chunk)
+    return written
 
-def download_slack_file(file_url, local_filename, token=SLACK_TOKEN):
+def download_slack_file(file_url, destination, token=SLACK_TOKEN, expected_size=None, expected_sha256=None):
+    """
+        Streams a private Slack file to a local path or a writable binary buffer.
+        Connections are reused through the shared session. Rate limits, server errors and broken transfers
+        are retried up to SLACK_DOWNLOAD_RETRIES times, waiting for Retry-After when Slack sends one.
+        Each attempt holds a "slack" stage slot, which is released before waiting to retry.
+        The size (and sha256 when given) is verified before the file is kept.
+        Raises SlackDownloadError if the file could not be downloaded.
+    """
     headers = {
         "Authorization": f"Bearer {token}"
     }
+    last_error = None
 
-    response = requests.get(file_url, headers=headers)
-    if response.status_code == 200:
-        with open(local_filename, "wb") as f:
-            f.write(response.content)
-        print(f"Saved to {local_filename}")
+    for attempt in range(SLACK_DOWNLOAD_RETRIES + 1):
+        digest = hashlib.sha256()
+        delay = 2 ** attempt
+        try:
+            with stage_limit("slack"), \
+                    slack_http_session().get(file_url, headers=headers, stream=True, timeout=SLACK_DOWNLOAD_TIMEOUT) as response:
+                if response.status_code in RETRY_STATUSES:
+                    delay = float(response.headers.get("Retry-After") or delay)
+                    raise requests.HTTPError(f"{response.status_code}, {response.reason}", response=response)
+                if response.status_code != 200:
+                    raise SlackDownloadError(f"Failed to download: {response.status_code}, {response.reason}")
+
+                # Slack answers an expired or unauthorised file url with an HTML login page
+                if response.headers.get("Content-Type", "").startswith("text/html"):
+                    raise SlackDownloadError("Failed to download: Slack returned a login page instead of the file")
+
+                if hasattr(destination, "write"):
+                    destination.seek(0)
+                    destination.truncate()
+                    written = _stream_to(response, destination, digest)
+                    destination.seek(0)
+                else:
+                    # Write next to the target and rename so a partial file is never left behind
+                    partial = f"{destination}.part"
+                    with open(partial, "wb") as f:
+                        written = _stream_to(response, f, digest)
+
+            if expected_size is not None and written != expected_size:
+                raise requests.RequestException(f"Size mismatch: expected {expected_size} bytes, got {written}")
+            if expected_sha256 and digest.hexdigest() != expected_sha256:
+                raise requests.RequestException("Checksum mismatch")
+
+            if not hasattr(destination, "write"):
+                os.replace(partial, destination)
+            print(f"Saved to {destination if isinstance(destination, str) else 'buffer'} ({written} bytes)")
+            return written
+
+        except SlackDownloadError:
+            raise
+        except requests.RequestException as e:
+            last_error = e
+            print(f"Download attempt {attempt + 1} failed: {e}")
+            if attempt < SLACK_DOWNLOAD_RETRIES:
+                RETRIES_TOTAL.inc(service="slack_download")
+                time.sleep(delay)
+        finally:
+            if not hasattr(destination, "write") and os.path.exists(f"{destination}.part"):
+                os.remove(f"{destination}.part")
+
+    raise SlackDownloadError(f"Failed to download after {SLACK_DOWNLOAD_RETRIES + 1} attempts: {last_error}")
+
+def send_file(channel_id, filename, message="Here’s an AI-generated Image! 🎨", file_name=None):
+    """
+        Queues an upload of a file path or binary buffer to the channel and returns a Future of the response.
+        The contents are read before returning, so the file can be removed as soon as this returns.
+        file_name is required when uploading from a buffer.
+    """
+    if hasattr(filename, "read"):
+        filename.seek(0)
+        content = filename.read()
+        filename.seek(0)
+        file_name = file_name or "image.png"
     else:
-        print(f"Failed to download: {response.status_code}, {response.text}")
+        with open(filename, "rb") as f:
+            content = f.read()
+        file_name = file_name or os.path.basename(filename)
 
-def send_file(channel_id, filename, message="Here’s an AI-generated Image! 🎨"):
-    with open(filename, "rb") as f:
-        try:
-            response = client.files_upload_v2(
-                channel=channel_id,
-                initial_comment=message,
-                file_uploads=[
-                    {
-                        "file": f,
-                        "filename": filename,
-                        "title": "Generated Image"
-                    }
-                ]
-            )
-            print(f"Upload successful! File ID: {response['file']['id']}")
-        except Exception as e:
-            print(f"Error uploading file: {e}")
\ No newline at end of file
+    def report(response):
+        if not response.exception():
+            print(f"Upload successful! File ID: {response.result()['file']['id']}")
+
+    upload = dispatcher.submit(
+        channel_id,
+        "files_upload_v2",
+        channel=channel_id,
+        initial_comment=message,
+        file_uploads=[
+            {
+                "file": content,
+                "filename": file_name,
+                "title": "Generated Image"
+            }
+        ]
+    )
+    upload.add_done_callback(report)
+    return upload
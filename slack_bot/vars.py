@@ -1,5 +1,5 @@
 import os
-from dotenv import load_dotenv
+import clients # Loads .env before the channels are read
 
 __all__ = ["CHANNEL_MAP"]
 
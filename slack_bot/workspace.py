@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import uuid
+import datetime
+
+__all__ = ["JobWorkspace", "default_scratch_dir"]
+
+SCRATCH_DIR = os.getenv("SCRATCH_DIR") # Defaults to /dev/shm (tmpfs) when it is available
+
+
+def default_scratch_dir():
+    """
+    Prefers tmpfs so that scratch files never touch the disk.
+    """
+    if SCRATCH_DIR:
+        return SCRATCH_DIR
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+class JobWorkspace:
+    """
+        A private scratch directory for a single job.
+        Holds the downloaded inputs and the image outputs of that job only,
+        so concurrent jobs never see or delete each other's files.
+        The directory is removed when the workspace is closed or the with-block exits.
+    """
+    def __init__(self, base_dir=None):
+        base_dir = base_dir or default_scratch_dir()
+        os.makedirs(base_dir, exist_ok=True)
+
+        self.root = tempfile.mkdtemp(prefix="slackbot-job-", dir=base_dir)
+        self.output_dir = os.path.join(self.root, "image_outputs")
+        os.makedirs(self.output_dir)
+
+    @staticmethod
+    def unique_stem():
+        """
+            Returns a timestamped name that is unique even within the same second.
+        """
+        now = datetime.datetime.now()
+        return f"{now.strftime('%Y-%m-%d-%H-%M-%S')}-{uuid.uuid4().hex[:8]}"
+
+    def output_path(self, filename):
+        return os.path.join(self.output_dir, filename)
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()